@@ -3,12 +3,16 @@ from os.path import expanduser
 import sys
 
 def main(pipeline_name):
-    pipeline = qp.Pipeline.load_state(pipeline_name)
-    result = pipeline.abort()
-    pipeline.close()
+    state_filename = qp.Pipeline.state_filename(pipeline_name)
+    with qp.Pipeline.load_state(state_filename) as pipeline:
+        # the cancelled jobs are stored on the state
+        pipeline.save_state(state_filename)
+        pipeline.abort()
 
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
         print("E: {} <pipeline_name>".format(sys.argv[0]), file=sys.stderr)
         sys.exit(-1)
+    pipeline_name = sys.argv[1]
+    main(pipeline_name)
@@ -0,0 +1,198 @@
+import questpipe as qp
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+
+SHAPES = ["fanout", "chain", "diamond"]
+PHASES = ["create_job", "render", "submit", "save_state", "load_state", "checkjobs", "abort"]
+
+COMMAND = """
+    echo {job_name} {sample_name} {lane}
+    cp {rundir}/input/{sample_name}_{lane}.fastq.gz {rundir}/output/
+    """
+
+
+class FakeBackend(qp.SchedulerBackend):
+    # In-process scheduler: jobs are queued forever and ids are sequential
+    min_poll_interval = 0
+
+    def __init__(self):
+        super().__init__()
+        self.next_id = 1
+        self.states = {}
+
+    def submit(self, submission):
+        job_id = str(self.next_id)
+        self.next_id += 1
+        self.states[job_id] = "Q"
+        if submission.array_size is not None:
+            for index in range(submission.array_size):
+                self.states["{}[{}]".format(job_id, index)] = "Q"
+        return "{}.fake".format(job_id), job_id
+
+    def unhold(self, job_id):
+        pass
+
+    def cancel(self, job_id):
+        self.states.pop(job_id, None)
+
+    def query_states(self, job_ids):
+        return {job_id: qp.MoabBackend.job_state(self.states[job_id], None) for job_id in job_ids if job_id in self.states}
+
+
+STUB_MSUB = """#!/bin/sh
+# the ids come from a counter on the stub folder; the jobs are submitted
+# at the same time, so it is locked (with a folder: mkdir is atomic)
+cat > /dev/null
+until mkdir "{0}/lock" 2> /dev/null; do sleep 0.01; done
+id=$(( $(cat "{0}/counter" 2> /dev/null || echo 0) + 1 ))
+echo "$id" > "{0}/counter"
+echo "$id" >> "{0}/queue"
+rmdir "{0}/lock"
+echo "$id.stub"
+"""
+
+STUB_QSTAT = """#!/bin/sh
+for id in $(cat "{0}/queue" 2>/dev/null); do
+    printf 'Job Id: %s.stub\\n    job_state = Q\\n\\n' "$id"
+done
+"""
+
+STUB_MJOBCTL = """#!/bin/sh
+echo "$@" > /dev/null
+"""
+
+
+def install_stub_executables(folder):
+    # fake 'msub', 'qstat' and 'mjobctl' on the PATH for the MOAB backend
+    for name, content in [("msub", STUB_MSUB), ("qstat", STUB_QSTAT), ("mjobctl", STUB_MJOBCTL)]:
+        filename = os.path.join(folder, name)
+        with open(filename, "wt") as f:
+            f.write(content.format(folder))
+        os.chmod(filename, 0o755)
+    os.environ["PATH"] = "{}:{}".format(folder, os.environ["PATH"])
+
+
+def build_pipeline(pipeline, shape, number_of_jobs):
+    # All the shapes have approximately 'number_of_jobs' jobs
+    if shape == "fanout":
+        root = pipeline.create_job("root", command=COMMAND, local_arguments=qp.Arguments(sample_name="root", lane=0))
+        children = [
+            pipeline.create_job(
+                "child_{sample_name}", dependences=[root], command=COMMAND,
+                local_arguments=qp.Arguments(sample_name="s{}".format(i), lane=0))
+            for i in range(max(number_of_jobs - 2, 1))]
+        pipeline.create_job("gather", dependences=children, command=COMMAND, local_arguments=qp.Arguments(sample_name="all", lane=0))
+    elif shape == "chain":
+        previous = []
+        for i in range(number_of_jobs):
+            job = pipeline.create_job(
+                "step_{sample_name}", dependences=previous, command=COMMAND,
+                local_arguments=qp.Arguments(sample_name="s{}".format(i), lane=0))
+            previous = [job]
+    elif shape == "diamond":
+        # like seq_pipeline.py: bcl2fastq, 4 fastqc and 1 tophat for each
+        # sample, a report and the quantification
+        root = pipeline.create_job("00_bcl2fastq", command=COMMAND, local_arguments=qp.Arguments(sample_name="all", lane=0))
+        alignments = []
+        for i in range(max((number_of_jobs - 3) // 5, 1)):
+            sample_name = "s{}".format(i)
+            lanes = [
+                pipeline.create_job(
+                    "01_fastqc_{sample_name}_{lane}", dependences=[root], command=COMMAND,
+                    local_arguments=qp.Arguments(sample_name=sample_name, lane=lane))
+                for lane in range(4)]
+            alignments.append(pipeline.create_job(
+                "02_tophat_{sample_name}", dependences=lanes, command=COMMAND,
+                local_arguments=qp.Arguments(sample_name=sample_name, lane="all")))
+        report = pipeline.create_job("03_alignment_report", dependences=alignments, command=COMMAND, local_arguments=qp.Arguments(sample_name="all", lane=0))
+        pipeline.create_job("04_quantification", dependences=[report], command=COMMAND, local_arguments=qp.Arguments(sample_name="all", lane=0))
+    else:
+        raise Exception("Unknown shape {}".format(shape))
+
+
+def timed(results, phase, function):
+    start = time.perf_counter()
+    value = function()
+    results[phase] = time.perf_counter() - start
+    return value
+
+
+def run_benchmark(shape, number_of_jobs, scheduler, max_workers, folder):
+    arguments = qp.Arguments(
+        msub_arguments=["-l walltime=24:00:00,nodes=1:ppn={num_processors}", "-N {job_name}"],
+        num_processors=8,
+        rundir=folder,
+        workdir="{rundir}",
+        outdir="{rundir}/logs",
+        errdir="{rundir}/logs")
+    backend = FakeBackend() if scheduler == "fake" else qp.MoabBackend()
+    pipeline = qp.Pipeline(name="benchmark", join_command_arguments=True, arguments=arguments, backend=backend)
+
+    results = {}
+    timed(results, "create_job", lambda: build_pipeline(pipeline, shape, number_of_jobs))
+    timed(results, "render", lambda: [job.render_command(job.command) for job in pipeline.jobs])
+    timed(results, "submit", lambda: pipeline.submit_all(max_workers=max_workers))
+    state_filename = os.path.join(folder, "pipeline.json")
+    timed(results, "save_state", lambda: pipeline.save_state(state_filename, journal=False))
+    loaded = timed(results, "load_state", lambda: qp.Pipeline.load_state(state_filename, backend=backend))
+    timed(results, "checkjobs", loaded.checkjobs)
+    timed(results, "abort", loaded.abort)
+    return len(pipeline.jobs), results
+
+
+def git_version():
+    try:
+        folder = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=folder, stderr=subprocess.DEVNULL).decode("utf8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the questpipe orchestration layer on synthetic pipelines")
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=SHAPES)
+    parser.add_argument("--jobs", nargs="+", type=int, default=[100, 1000, 10000])
+    parser.add_argument("--scheduler", choices=["fake", "stub"], default="fake",
+                        help="in-process fake backend, or MOAB backend with stub executables on the PATH")
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args()
+
+    report = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "timestamp": datetime.now().isoformat(),
+        "scheduler": args.scheduler,
+        "max_workers": args.max_workers,
+        "results": []}
+
+    for shape in args.shapes:
+        for number_of_jobs in args.jobs:
+            with tempfile.TemporaryDirectory() as folder:
+                if args.scheduler == "stub":
+                    stub_folder = os.path.join(folder, "bin")
+                    os.mkdir(stub_folder)
+                    old_path = os.environ["PATH"]
+                    install_stub_executables(stub_folder)
+                try:
+                    jobs, results = run_benchmark(shape, number_of_jobs, args.scheduler, args.max_workers, folder)
+                finally:
+                    if args.scheduler == "stub":
+                        os.environ["PATH"] = old_path
+            report["results"].append({"shape": shape, "jobs": jobs, "seconds": results})
+            print("{:8} {:6} jobs: {}".format(shape, jobs, " ".join("{}={:.3f}s".format(phase, results[phase]) for phase in PHASES)))
+
+    with open(args.output, "wt") as f:
+        f.write(json.dumps(report, sort_keys=True, indent=4, separators=(',', ': ')))
+    print("Stored at {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,17 +3,27 @@ from os.path import expanduser
 import sys
 
 
-def main(pipeline_name):
+def main(pipeline_name, force=False):
     pipeline = qp.Pipeline.load_state(pipeline_name)
-    queue_count, running_count, completed_count = pipeline.checkjobs()
+    # the other questpipe processes of the user share the scheduler query
+    pipeline.use_status_cache()
+    counts = pipeline.checkjobs(force)
+    queue_count, running_count, completed_count = counts
     print("Completed: {}".format(completed_count))
     print("Running:   {}".format(running_count))
     print("Idles:     {}".format(queue_count))
+    if counts.unknown > 0:
+        print("Unknown:   {}".format(counts.unknown))
+    if pipeline.monitor.age is None:
+        # the scheduler could not be asked
+        print("Updated:   unknown")
+    else:
+        print("Updated:   {:.0f} seconds ago".format(pipeline.monitor.age))
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("E: {} <pipeline_name>".format(sys.argv[0]), file=sys.stderr)
+    if len(sys.argv) not in [2, 3] or (len(sys.argv) == 3 and sys.argv[2] != "--refresh"):
+        print("E: {} <pipeline_name> [--refresh]".format(sys.argv[0]), file=sys.stderr)
         sys.exit(-1)
     pipeline_name = sys.argv[1]
-    main(pipeline_name)
\ No newline at end of file
+    main(pipeline_name, force=len(sys.argv) == 3)
@@ -21,6 +21,7 @@ def main(pipeline_name):
 
     with qp.Pipeline(name="mypipeline", join_command_arguments=True, arguments=arguments) as pipeline:
         pipeline.debug_to_filename("{outdir}/pipeline.log", create_parent_folders=True)
+        pipeline.save_state("{outdir}/pipeline.json")
 
         t1 = pipeline.create_job(name="first_task")
         t1.prepare_async_run("""
@@ -1,39 +1,86 @@
+import asyncio
+import glob
+import hashlib
 import json
+import math
 import os
 import pathlib
-import re
+import queue
+import signal
 import subprocess
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from .accounting import ResourceHistory
+from .backends import JobSubmission, LocalBackend, MoabBackend, SchedulerBackend, SchedulerError
+from .dag import AfterokAncestors, CriticalPath, RuntimeHistory, dependence_levels, format_seconds, job_parents, reduced_dependences
+from .logger import PipelineLogger
+from .metrics import Metrics
+from .monitor import JobCounts, PipelineMonitor
+from .process import CommandError, CommandStream, kill_process, run_command
+from .scatter import ScatterGather, chunk_count, split_records_command
+from .session import CommandSession, SessionError
+from .staging import StagingCache
+from .state import StateJournal, write_atomically
+from .statuscache import StatusCache
+from .templates import TemplateResolver
+from .throttle import SubmissionThrottle
 
 
 class Arguments:
+    # 'values' stores only the values of this layer: the rest are looked up
+    # on the parent layers, so 'combine' does not copy the parent values
     def __init__(self, **kwargs):
         self.values = kwargs
+        self.parent = None
+        self.__resolver = None
 
     @staticmethod
     def from_json(data):
         return Arguments(**data)
 
     def get(self, key, default_value):
-        return self.values.get(key, default_value)
+        arguments = self
+        while arguments is not None:
+            if key in arguments.values:
+                return arguments.values[key]
+            arguments = arguments.parent
+        return default_value
 
     def to_json(self):
-        return self.values
+        if self.parent is None:
+            return self.values
+        values = self.parent.to_json().copy()
+        values.update(self.values)
+        return values
+
+    def resolver(self):
+        # the values are not expected to change after the first rendering
+        if self.__resolver is None:
+            parent_resolver = self.parent.resolver() if self.parent is not None else None
+            self.__resolver = TemplateResolver(self.values, parent=parent_resolver)
+        return self.__resolver
 
     def combine(self, other):
-        values = self.values.copy()
-        if other is not None:
-            for k, v in other.values.items():
-                values[k] = v 
-        return Arguments(**values)
+        arguments = Arguments(**(other.to_json() if other is not None else {}))
+        arguments.parent = self
+        return arguments
 
     def __repr__(self):
-        return self.values.__repr__()        
+        return self.to_json().__repr__()
 
 
 class MJob:
     CREATED = 0
     RUNNING = 1
     COMPLETED = 2
+    SKIPPED = 3
+
+    # why a job was skipped: a job that was not needed did not run, so its
+    # dependants cannot run either
+    UP_TO_DATE = "up to date"
+    NOT_NEEDED = "not needed"
 
     def __init__(self, pipeline, name, msub_arguments, dependences, notokdependences, workdir, outdir, errdir, arguments, moab_job_name, moab_job_id, status, command):
         self.pipeline = pipeline
@@ -49,6 +96,31 @@ class MJob:
         self.moab_job_id = moab_job_id
         self.status = status
         self.command = command
+        self.hold = False
+        self.array = None
+        self.array_index = None
+        self.exit_code = None
+        self.index = None
+        self.inputs = []
+        self.outputs = []
+        self.fingerprint = None
+        self.skip_reason = None
+        # estimated seconds (see Pipeline.critical_path) and observed times
+        self.runtime = None
+        self.started = None
+        self.finished = None
+        # resources used, reported by the scheduler (see SchedulerBackend.query_usage)
+        self.usage = None
+        # template values of the staged inputs and the files copied to the
+        # node-local scratch (see 'stage')
+        self.staged = {}
+        self.scratch_files = []
+        # scheduler hints set by Pipeline.prioritize (and the barriers)
+        self.priority = None
+        self.walltime = None
+        self.ppn = None
+        self.__resolver = None
+        self.__submission = None
 
     @staticmethod
     def create_new(pipeline, name, msub_arguments, dependences, notokdependences, workdir, outdir, errdir, arguments):
@@ -56,7 +128,7 @@ class MJob:
 
     @staticmethod
     def from_json(pipeline, msub_arguments, data):
-        return MJob(
+        job = MJob(
             pipeline, 
             data["name"], 
             msub_arguments,
@@ -65,11 +137,25 @@ class MJob:
             data["workdir"],
             data["outdir"],
             data["errdir"],
-            pipeline.arguments,
+            pipeline.arguments.combine(Arguments.from_json(data.get("arguments", {}))),
             data["moab_job_name"],
             data["moab_job_id"],
             data["status"],
             data["command"])
+        job.load_optional_fields(data)
+        return job
+
+    def load_optional_fields(self, data):
+        # fields missing on states saved by older versions
+        self.exit_code = data.get("exit_code")
+        self.inputs = data.get("inputs", [])
+        self.outputs = data.get("outputs", [])
+        self.fingerprint = data.get("fingerprint")
+        self.runtime = data.get("runtime")
+        self.started = data.get("started")
+        self.finished = data.get("finished")
+        self.usage = data.get("usage")
+        self.skip_reason = data.get("skip_reason")
 
     def to_json(self):
         result = {
@@ -80,21 +166,175 @@ class MJob:
             "moab_job_name": self.moab_job_name,
             "moab_job_id": self.moab_job_id,
             "status": self.status,
+            "exit_code": self.exit_code,
             "command": self.command}
+        if len(self.inputs) > 0 or len(self.outputs) > 0:
+            result["inputs"] = self.inputs
+            result["outputs"] = self.outputs
+            result["fingerprint"] = self.fingerprint
+        for key in ["runtime", "started", "finished", "usage", "skip_reason"]:
+            if getattr(self, key) is not None:
+                result[key] = getattr(self, key)
+        if self.arguments is not self.pipeline.arguments and len(self.arguments.values) > 0:
+            # the pipeline arguments are stored once, on the pipeline
+            result["arguments"] = self.arguments.values
         if self.dependences is not None:
             result["dependences"] = [job.moab_job_id for job in self.dependences]
+            result["dependence_refs"] = [job.ref for job in self.dependences]
         if self.notokdependences is not None:
             result["notokdependences"] = [job.moab_job_id for job in self.notokdependences]
+            result["notokdependence_refs"] = [job.ref for job in self.notokdependences]
+        if self.array is not None:
+            result["array"] = self.array.index
+            result["array_index"] = self.array_index
         return result
 
-    def __parse_string(self, value, max_recursive_loops=10):
-        for i in range(max_recursive_loops):
-            new_value = value.format(job_name=self.name, **self.arguments.values)
-            if new_value != value:
-                value = new_value
-            else:
-                return new_value
-        raise Exception("recursive parsing")
+    @property
+    def ref(self):
+        # identifies the job on the saved state, even before it has an id
+        return "j{}".format(self.index)
+
+    @property
+    def scheduler_job_id(self):
+        # the id known by the scheduler (the tasks of a packed job share it)
+        if self.array is not None:
+            return self.array.element_scheduler_id(self)
+        return self.moab_job_id
+
+    def parse_string(self, value):
+        return self.__parse_string(value)
+
+    def render_command(self, command):
+        return self.__parse_string(command)
+
+    def stage(self, name, path, files=None, destination=None, scratch=False, verify=True):
+        # Stages the input 'path' (and the files of the glob patterns 'files',
+        # e.g. all the files of an index) through the staging cache of the
+        # pipeline (see Pipeline.use_staging). '{name}' is the staged 'path' on
+        # the commands of the job: a link on 'destination' (a folder) or, with
+        # 'scratch', a copy on the node-local scratch made (and checked, and
+        # removed at the end) by the job script. Call it before rendering the
+        # command of the job (async_run)
+        staging = self.pipeline.staging
+        if staging is None:
+            raise Exception("Staging is not enabled (see Pipeline.use_staging)")
+        eff_path = self.__parse_string(path)
+        filenames = [eff_path] if files is None else [filename for pattern in self.render_files(files) for filename in sorted(glob.glob(pattern))]
+        if len(filenames) == 0:
+            raise Exception("Nothing to stage for {} on {}".format(name, self.name))
+        if scratch:
+            variable = "__qp_scratch" if self.array is None else "__qp_task_scratch"
+            for filename in filenames:
+                object_filename, checksum = staging.store(filename)
+                self.scratch_files.append((object_filename, "{}/{}".format(name, os.path.basename(filename)), checksum if verify else None))
+            value = "${}/{}/{}".format(variable, name, os.path.basename(eff_path))
+        else:
+            if destination is None:
+                raise Exception("Staging {} on {} needs a destination or scratch".format(name, self.name))
+            eff_destination = self.__parse_string(destination)
+            for filename in filenames:
+                object_filename, _ = staging.store(filename)
+                staging.link(object_filename, os.path.join(eff_destination, os.path.basename(filename)))
+            value = os.path.join(eff_destination, os.path.basename(eff_path))
+        # the value is not a template
+        self.staged[name] = value.replace("{", "{{").replace("}", "}}")
+        self.reset_templates()
+        return value
+
+    def staging_script(self):
+        if len(self.scratch_files) == 0:
+            return ""
+        variable = "__qp_scratch" if self.array is None else "__qp_task_scratch"
+        return StagingCache.scratch_script(variable, self.scratch_files)
+
+    def reset_templates(self):
+        self.__resolver = None
+
+    def extra_msub_arguments(self):
+        # the hints of Pipeline.prioritize, after the arguments of the pipeline
+        arguments = []
+        if self.priority is not None:
+            arguments.append("-p {}".format(self.priority))
+        if self.walltime is not None:
+            arguments.append("-l walltime={}".format(format_seconds(self.walltime)))
+        if self.ppn is not None:
+            arguments.append("-l nodes=1:ppn={}".format(self.ppn))
+        return arguments
+
+    def array_size(self):
+        return None
+
+    @property
+    def observed_runtime(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def estimate_runtime(self, history, default_runtime):
+        # seconds: the 'runtime' given to create_job, the runtime of the same
+        # job on a previous run, the median of the jobs with the same name
+        # template, or 'default_runtime'
+        if self.runtime is not None:
+            return self.runtime
+        return history.estimate(self.parse_string(self.name), self.name, default_runtime)
+
+    def has_runtime_estimate(self, history):
+        # False when the estimate would be the default runtime
+        return self.runtime is not None or history.knows(self.parse_string(self.name), self.name)
+
+    def render_files(self, patterns):
+        return [self.__parse_string(pattern) for pattern in patterns]
+
+    @property
+    def exit_codes(self):
+        return [self.exit_code]
+
+    @property
+    def is_finished(self):
+        return self.status in [MJob.COMPLETED, MJob.SKIPPED]
+
+    def compute_fingerprint(self):
+        # Hash of the rendered job: command, arguments, inputs and outputs. The
+        # inputs of a job usually do not exist when it is submitted, so their
+        # contents are checked with the modification times (see is_up_to_date)
+        h = hashlib.sha256()
+        values = [self.render_command(self.command), self.__parse_string(self.workdir)]
+        values += [self.__parse_string(arg) for arg in self.msub_arguments]
+        values += self.render_files(self.inputs) + ["->"] + self.render_files(self.outputs)
+        for value in values:
+            h.update(bytes(value, "utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def on_submitted(self):
+        pass
+
+    def set_status(self, status):
+        self.status = status
+
+    def __parse_string(self, value):
+        if self.__resolver is None or self.__resolver.parent is not self.arguments.resolver():
+            values = {"job_name": self.name}
+            if self.array is not None:
+                values.update(self.array.staged)
+            values.update(self.staged)
+            self.__resolver = TemplateResolver(values, parent=self.arguments.resolver())
+        metrics = self.pipeline.metrics
+        if metrics is None:
+            return self.__resolver.render(value)
+        with metrics.timer("render"):
+            return self.__resolver.render(value)
+
+    @property
+    def is_declared(self):
+        return self.status == MJob.CREATED and self.moab_job_id is None and self.command is not None
+
+    def launch(self, hold=None, NUMBER_OF_ATTEMPTS=3):
+        if self.command is None:
+            raise Exception("MJob {} has no command to launch".format(self.name))
+        if hold is None:
+            hold = self.hold
+        return self.__async_run(self.command, hold=hold, NUMBER_OF_ATTEMPTS=NUMBER_OF_ATTEMPTS)
 
     def prepare_async_run(self, command, NUMBER_OF_ATTEMPTS=3):
         self.__async_run(command, hold=True, NUMBER_OF_ATTEMPTS=NUMBER_OF_ATTEMPTS)
@@ -103,234 +343,917 @@ class MJob:
         self.__async_run(command, hold=False, NUMBER_OF_ATTEMPTS=NUMBER_OF_ATTEMPTS)
 
     def __async_run(self, command, hold, NUMBER_OF_ATTEMPTS=3):
+        submission = self.__prepare_submission(command, hold)
+        if submission is None:
+            return self
+
+        metrics = self.pipeline.metrics
+        throttle = self.pipeline.throttle
+        for i in range(NUMBER_OF_ATTEMPTS):
+            if i > 0:
+                time.sleep(throttle.retry_delay(i - 1))
+            throttle.wait()
+            self.pipeline.log("I: submit attempt {}: {}".format(i + 1, submission))
+            try:
+                if metrics is None:
+                    moab_job_name, moab_job_id = self.pipeline.backend.submit(submission)
+                else:
+                    metrics.count("submit_attempts")
+                    with metrics.timer("submit_attempt"):
+                        moab_job_name, moab_job_id = self.pipeline.backend.submit(submission)
+            except SchedulerError as e:
+                error = e
+                self.__submit_failed(e)
+                continue
+            except BaseException:
+                # the submission may be the probe of the circuit breaker
+                throttle.released()
+                raise
+            throttle.succeeded()
+            self.__submitted(moab_job_name, moab_job_id)
+            break
+        else:
+            # when for exit is not because break
+            raise Exception("Cannot start job after {} attemps: {}".format(NUMBER_OF_ATTEMPTS, error))
+        return self
+
+    def submit(self, hold=None, NUMBER_OF_ATTEMPTS=3):
+        # asyncio version of 'launch': 'await job.submit()' submits the job
+        # once its dependences are submitted (they are submitted too if they
+        # were declared with a command). Awaiting it again returns the same
+        # submission
+        if self.__submission is None:
+            self.__submission = asyncio.ensure_future(self.__submit(hold, NUMBER_OF_ATTEMPTS))
+        return self.__submission
+
+    async def __submit(self, hold, NUMBER_OF_ATTEMPTS):
+        if self.command is None:
+            raise Exception("MJob {} has no command to launch".format(self.name))
+        if hold is None:
+            hold = self.hold
+        parents = [parent for parent in job_parents(self) if parent.is_declared or parent.__submission is not None]
+        if len(parents) > 0:
+            await asyncio.gather(*(parent.submit() for parent in parents))
+        submission = self.__prepare_submission(self.command, hold)
+        if submission is None:
+            return self
+
+        metrics = self.pipeline.metrics
+        throttle = self.pipeline.throttle
+        for i in range(NUMBER_OF_ATTEMPTS):
+            if i > 0:
+                await asyncio.sleep(throttle.retry_delay(i - 1))
+            await throttle.wait_async()
+            self.pipeline.log("I: submit attempt {}: {}".format(i + 1, submission))
+            start = time.perf_counter()
+            try:
+                moab_job_name, moab_job_id = await self.pipeline.backend.submit_async(submission)
+            except SchedulerError as e:
+                error = e
+                self.__submit_failed(e)
+                continue
+            except BaseException:
+                throttle.released()
+                raise
+            finally:
+                if metrics is not None:
+                    metrics.count("submit_attempts")
+                    metrics.add("submit_attempt", time.perf_counter() - start)
+            throttle.succeeded()
+            self.__submitted(moab_job_name, moab_job_id)
+            break
+        else:
+            raise Exception("Cannot start job after {} attemps: {}".format(NUMBER_OF_ATTEMPTS, error))
+        return self
+
+    def __submit_failed(self, error):
+        self.pipeline.log("E: submission of {} failed: {}".format(self.name, error))
+        if self.pipeline.metrics is not None:
+            self.pipeline.metrics.count("submit_failures")
+        if not error.transient:
+            # the scheduler answered, the job is wrong: a half open circuit
+            # closes, so the other submissions do not wait forever
+            self.pipeline.throttle.succeeded()
+            raise Exception("Cannot start job {}: {}".format(self.name, error))
+        if self.pipeline.throttle.failed():
+            self.pipeline.log("E: the scheduler is failing, pausing the submissions for {} seconds".format(self.pipeline.throttle.breaker.reset_timeout))
+
+    def __prepare_submission(self, command, hold):
+        # returns None when the job is skipped
         if self.status != MJob.CREATED:
             raise Exception("MJob is running")
+        if self.array is not None:
+            raise Exception("MJob {} is an element of a job array and it is submitted with the array".format(self.name))
         self.command = command
-        eff_command = self.__parse_string(command)
+        if len(self.inputs) > 0 or len(self.outputs) > 0:
+            self.fingerprint = self.compute_fingerprint()
+        if self.__skip():
+            return None
+        eff_command = self.staging_script() + self.render_command(command)
         eff_msub_arguments = [self.__parse_string(arg) for arg in self.msub_arguments]
-        if self.dependences is not None and len(self.dependences) > 0:
-            self.pipeline.log("I: dep: {}".format([job.moab_job_id for job in self.dependences]))
-            for mjob in self.dependences:
+        eff_msub_arguments.extend(self.extra_msub_arguments())
+        dependences = []
+        notokdependences = []
+        # skipped jobs are up to date: there is nothing to wait for
+        running_dependences = [job for job in self.dependences or [] if job.status != MJob.SKIPPED]
+        if len(running_dependences) > 0:
+            self.pipeline.log("I: dep: {}".format([job.moab_job_id for job in running_dependences]))
+            for mjob in running_dependences:
                 if mjob.moab_job_id is None:
                     raise Exception("MJob must be running in order to be dependence")
-            moab_job_ids = [mjob.moab_job_id for mjob in self.dependences]
-            eff_msub_arguments.append("-l depend=afterok:{}".format(":".join(moab_job_ids)))
+            # the tasks of a packed job share the id
+            dependences = list(dict.fromkeys(mjob.scheduler_job_id for mjob in running_dependences))
 
         if self.notokdependences is not None and len(self.notokdependences) > 0:
             self.pipeline.log("I: notok dep: {}".format([job.moab_job_id for job in self.notokdependences]))
             for mjob in self.notokdependences:
                 if mjob.moab_job_id is None:
                     raise Exception("MJob must be running in order to be not ok dependence")
-            moab_job_ids = [mjob.moab_job_id for mjob in self.notokdependences]
-            eff_msub_arguments.append("-l depend=afternotok:{}".format(":".join(moab_job_ids)))
+                if mjob.scheduler_job_id != mjob.moab_job_id:
+                    # the packed job fails when any of its tasks fails
+                    raise Exception("MJob {} is a task of a packed job and it cannot be a not ok dependence".format(mjob.name))
+            notokdependences = list(dict.fromkeys(mjob.scheduler_job_id for mjob in self.notokdependences))
 
-        workdir = self.__parse_string(self.workdir)
-        errdir = self.__parse_string(self.errdir)
-        outdir = self.__parse_string(self.outdir)
+        submission = JobSubmission(
+            self.__parse_string(self.name),
+            eff_command,
+            eff_msub_arguments,
+            dependences,
+            notokdependences,
+            self.__parse_string(self.workdir),
+            self.__parse_string(self.outdir),
+            self.__parse_string(self.errdir),
+            hold,
+            self.array_size())
+        return submission
 
-        eff_msub_arguments.append("-d \"{}\"".format(workdir))
-        eff_msub_arguments.append("-e \"{}\"".format(errdir))
-        eff_msub_arguments.append("-o \"{}\"".format(outdir))
-        
-        if hold:
-            eff_msub_arguments.append("-h")
-    
-        for i in range(NUMBER_OF_ATTEMPTS):
-            self.pipeline.log("I: msub attempt {}: {}".format(i + 1, eff_msub_arguments))
-            stdin, stdout, stderr = self.pipeline.exec_command("msub", eff_msub_arguments, input=eff_command)
-            result = len(stderr) == 0
-            if result:
-                self.moab_job_name = stdout.decode('utf8').strip()
-                self.moab_job_id = self.moab_job_name.split(".")[0]
-                self.status = MJob.RUNNING
-                self.pipeline.log("I: Running {}".format(self.moab_job_id))
-                break
+    def __submitted(self, moab_job_name, moab_job_id):
+        self.moab_job_name = moab_job_name
+        self.moab_job_id = moab_job_id
+        self.status = MJob.RUNNING
+        self.on_submitted()
+        if self.pipeline.metrics is not None:
+            self.pipeline.metrics.count("jobs_submitted")
+        self.pipeline.log("I: Running {}".format(self.moab_job_id))
+        self.pipeline.record("submitted", self, moab_job_name=self.moab_job_name, moab_job_id=self.moab_job_id, status=self.status, command=self.command, fingerprint=self.fingerprint)
+
+    @property
+    def is_not_needed(self):
+        if self.status != MJob.SKIPPED:
+            return False
+        return self.skip_reason == MJob.NOT_NEEDED or (self.array is not None and self.array.skip_reason == MJob.NOT_NEEDED)
+
+    def __skip(self):
+        # A job is skipped when its parents are skipped and a previous run of
+        # the same job (same fingerprint) succeeded and left its outputs; a job
+        # waiting for the failure of a skipped job is not needed either, and
+        # neither are the jobs waiting for a job that was not needed (the
+        # scheduler would never run them)
+        dependences = (self.dependences or []) + (self.notokdependences or [])
+        if any(job.is_not_needed for job in dependences):
+            reason, explanation = MJob.NOT_NEEDED, "a dependence was not needed"
+        elif any(job.status == MJob.SKIPPED for job in self.notokdependences or []):
+            reason, explanation = MJob.NOT_NEEDED, "its not ok dependences succeeded"
+        elif all(job.status == MJob.SKIPPED for job in dependences) and self.pipeline.is_up_to_date(self):
+            reason, explanation = MJob.UP_TO_DATE, "it is up to date"
         else:
-            # when for exit is not because break
-            raise Exception("Cannot start job after {} attemps: {}".format(NUMBER_OF_ATTEMPTS, stderr))
-        return self
+            return False
+        self.set_status(MJob.SKIPPED)
+        self.skip_reason = reason
+        self.pipeline.log("I: Skipping {}: {}".format(self.name, explanation))
+        self.pipeline.record("skipped", self, status=self.status, command=self.command, fingerprint=self.fingerprint, skip_reason=self.skip_reason)
+        return True
 
     def unhold(self):
         self.pipeline.log("I: unholding {}".format(self.moab_job_id))
-        stdin, stdout, stderr = self.pipeline.exec_command("mjobctl", ["-u", "all", self.moab_job_id])
-        result = len(stderr) == 0
-        if result:
-            self.status = MJob.RUNNING
+        try:
+            self.pipeline.backend.unhold(self.scheduler_job_id)
+            self.set_status(MJob.RUNNING)
             self.pipeline.log("I: Unhold {}".format(self.moab_job_id))
-        else:
-            self.pipeline.log("E: Error unholding job {}: {}".format(self.moab_job_id, stderr))
-            self.status = MJob.CREATED       
-        
+            self.pipeline.record("unheld", self, status=self.status)
+        except SchedulerError as e:
+            self.pipeline.log("E: Error unholding job {}: {}".format(self.moab_job_id, e))
+            self.status = MJob.CREATED
+
     def cancel(self):
         self.pipeline.log("I: cancelling {}".format(self.moab_job_id))
-        stdin, stdout, stderr = self.pipeline.exec_command("mjobctl", ["-c", self.moab_job_id])
-        result = len(stderr) == 0
-        if result:
-            self.status = MJob.COMPLETED
+        try:
+            self.pipeline.backend.cancel(self.scheduler_job_id)
+            self.set_status(MJob.COMPLETED)
             self.pipeline.log("I: Cancelled {}".format(self.moab_job_id))
-        else:
-            self.pipeline.log("E: Error cancelling job {}: {}".format(self.moab_job_id, stderr))
-            self.status = MJob.CREATED       
+            self.pipeline.record("cancelled", self, status=self.status)
+        except SchedulerError as e:
+            self.pipeline.log("E: Error cancelling job {}: {}".format(self.moab_job_id, e))
+            self.status = MJob.CREATED
         
     @property
     def is_running(self):
-        if self.status in [MJob.CREATED, MJob.COMPLETED]:
+        if self.status in [MJob.CREATED, MJob.COMPLETED, MJob.SKIPPED]:
             return False
-        stdin, stdout, stderr = self.pipeline.exec_command("checkjob", ["-v {}".format(self.moab_job_id)])
-        for line in stdout.splitlines():
-            line = line.decode("utf8")
-            if line.endswith('\n'):
-                line = line[:-1]
-            index = line.find(':')
-            if index == -1:
-                continue
-            name = line[0:index].strip()
-            if name != 'State':
-                continue
-            param = line[index+1:].strip()
-            if param == "Completed":
-                self.status = MJob.COMPLETED
-                return False
+        state = self.pipeline.monitor.state(self)
+        return state not in PipelineMonitor.FINISHED_STATES
+
+
+class MJobArray(MJob):
+    # A job array submitted at once ('msub -t' on MOAB): every element is a MJob
+    # with its own arguments, and the script selects the element command
+    # through the array index given by the scheduler
+    def __init__(self, pipeline, name, msub_arguments, dependences, notokdependences, workdir, outdir, errdir, arguments, moab_job_name, moab_job_id, status, command, elements):
+        super().__init__(pipeline, name, msub_arguments, dependences, notokdependences, workdir, outdir, errdir, arguments, moab_job_name, moab_job_id, status, command)
+        self.elements = elements
+
+    @staticmethod
+    def from_json(pipeline, msub_arguments, data):
+        job_array = MJobArray(
+            pipeline,
+            data["name"],
+            msub_arguments,
+            [],   # fix dependences later
+            [],   # fix notok dependences later
+            data["workdir"],
+            data["outdir"],
+            data["errdir"],
+            pipeline.arguments,
+            data["moab_job_name"],
+            data["moab_job_id"],
+            data["status"],
+            data["command"],
+            [])   # elements are attached when loading the jobs
+        job_array.load_optional_fields(data)
+        return job_array
+
+    def to_json(self):
+        result = super().to_json()
+        result["size"] = len(self.elements)
+        return result
+
+    @property
+    def ref(self):
+        return "a{}".format(self.index)
+
+    def reset_templates(self):
+        # the elements see the values staged on the array
+        super().reset_templates()
+        for element in self.elements:
+            element.reset_templates()
+
+    def render_command(self, command):
+        lines = ['case "${MOAB_JOBARRAYINDEX:-$PBS_ARRAYID}" in']
+        for element in self.elements:
+            lines.append("{})".format(element.array_index))
+            if len(element.scratch_files) > 0:
+                # the scratch of the element has its own trap (see 'stage')
+                lines.append("(\n{}{}\n)".format(element.staging_script(), element.parse_string(command)))
             else:
-                return True
-        return False 
+                lines.append(element.parse_string(command))
+            lines.append(";;")
+        lines.append("esac")
+        return "\n".join(lines)
+
+    def array_size(self):
+        return len(self.elements)
+
+    def render_files(self, patterns):
+        return [filename for element in self.elements for filename in element.render_files(patterns)]
+
+    @property
+    def exit_codes(self):
+        return [element.exit_code for element in self.elements]
+
+    @property
+    def is_finished(self):
+        # the scheduler reports the state of the elements
+        return self.status in [MJob.COMPLETED, MJob.SKIPPED] or all(element.is_finished for element in self.elements)
+
+    def on_submitted(self):
+        for element in self.elements:
+            element.command = self.command
+            element.moab_job_name = "{}[{}]".format(self.moab_job_name, element.array_index)
+            element.moab_job_id = "{}[{}]".format(self.moab_job_id, element.array_index)
+            element.status = self.status
+
+    def set_status(self, status):
+        self.status = status
+        for element in self.elements:
+            element.status = status
+
+    def update_status(self):
+        # the scheduler only reports the elements: the array is completed
+        # when all of them are
+        if self.status == MJob.RUNNING and all(element.is_finished for element in self.elements):
+            self.status = MJob.COMPLETED
+            self.pipeline.record("completed", self, status=self.status)
+
+    @property
+    def is_running(self):
+        if self.status in [MJob.CREATED, MJob.COMPLETED, MJob.SKIPPED]:
+            return False
+        running = any(element.is_running for element in self.elements)
+        self.update_status()
+        return running
+
+    def element_scheduler_id(self, element):
+        return element.moab_job_id
+
+    def estimate_runtime(self, history, default_runtime):
+        # the elements run at the same time
+        if self.runtime is not None:
+            return self.runtime
+        return max(element.estimate_runtime(history, default_runtime) for element in self.elements)
+
+    def has_runtime_estimate(self, history):
+        return self.runtime is not None or all(element.has_runtime_estimate(history) for element in self.elements)
+
+    def element_state(self, element, state, exit_code):
+        # (state, exit code) of an element from the ones of the scheduler
+        return state, exit_code
+
+
+class MPackedJob(MJobArray):
+    # Many short tasks run by a single scheduler job, 'ppn' at the same time.
+    # Every task is a MJob (an element, like on job arrays) that can be used
+    # as a dependence: the dependants wait for the whole packed job, so a job
+    # that depends on a task does not run when any other task fails, and the
+    # tasks cannot be not ok dependences. The exit code of every task is
+    # written on '{outdir}/{name}.tasks.<job id>'
+    def __init__(self, pipeline, name, msub_arguments, dependences, notokdependences, workdir, outdir, errdir, arguments, moab_job_name, moab_job_id, status, command, elements, ppn=1, task_walltime=None):
+        super().__init__(pipeline, name, msub_arguments, dependences, notokdependences, workdir, outdir, errdir, arguments, moab_job_name, moab_job_id, status, command, elements)
+        self.ppn = ppn
+        self.task_walltime = task_walltime
+
+    @staticmethod
+    def from_json(pipeline, msub_arguments, data):
+        packed_job = MPackedJob(
+            pipeline,
+            data["name"],
+            msub_arguments,
+            [],   # fix dependences later
+            [],   # fix notok dependences later
+            data["workdir"],
+            data["outdir"],
+            data["errdir"],
+            pipeline.arguments,
+            data["moab_job_name"],
+            data["moab_job_id"],
+            data["status"],
+            data["command"],
+            [],   # elements are attached when loading the jobs
+            data["ppn"],
+            data.get("task_walltime"))
+        packed_job.load_optional_fields(data)
+        return packed_job
+
+    def to_json(self):
+        result = super().to_json()
+        result["packed"] = True
+        result["ppn"] = self.ppn
+        result["task_walltime"] = self.task_walltime
+        return result
+
+    def array_size(self):
+        return None
+
+    def extra_msub_arguments(self):
+        # the resources of the group, after the ones of the pipeline
+        arguments = []
+        if self.priority is not None:
+            arguments.append("-p {}".format(self.priority))
+        resources = ["nodes=1:ppn={}".format(self.ppn)]
+        if self.walltime is not None:
+            resources.append("walltime={}".format(format_seconds(self.walltime)))
+        elif self.task_walltime is not None:
+            resources.append("walltime={}".format(format_seconds(self.task_walltime * self.waves)))
+        arguments.append("-l {}".format(",".join(resources)))
+        return arguments
+
+    @property
+    def waves(self):
+        # the tasks run 'ppn' at the same time
+        return -(-len(self.elements) // self.ppn)
+
+    def estimate_runtime(self, history, default_runtime):
+        if self.runtime is not None:
+            return self.runtime * self.waves
+        return max(element.estimate_runtime(history, default_runtime) for element in self.elements) * self.waves
+
+    def status_filename(self):
+        return os.path.join(self.parse_string(self.outdir), "{}.tasks".format(self.parse_string(self.name)))
+
+    def render_command(self, command):
+        lines = []
+        for element in self.elements:
+            lines.append("__qp_task_{}() {{".format(element.array_index))
+            lines.append(element.staging_script() + element.parse_string(command))
+            lines.append("}")
+        lines += [
+            '__qp_status="{}.${{PBS_JOBID%%.*}}"'.format(self.status_filename()),
+            ': > "$__qp_status"',
+            '__qp_run() { ( "__qp_task_$1" ); echo "$1 $?" >> "$__qp_status"; }',
+            "for __qp_index in {}; do".format(" ".join(str(element.array_index) for element in self.elements)),
+            '    while [ "$(jobs -pr | wc -l)" -ge {} ]; do wait -n 2> /dev/null || sleep 1; done'.format(self.ppn),
+            '    __qp_run "$__qp_index" &',
+            "done",
+            "wait",
+            "awk '$2 != 0 { failed = 1 } END { exit failed }' \"$__qp_status\""]
+        return "\n".join(lines)
+
+    def on_submitted(self):
+        for element in self.elements:
+            element.command = self.command
+            element.moab_job_name = "{}#{}".format(self.moab_job_name, element.array_index)
+            element.moab_job_id = "{}#{}".format(self.moab_job_id, element.array_index)
+            element.status = self.status
+
+    def element_scheduler_id(self, element):
+        return self.moab_job_id
+
+    def task_exit_codes(self):
+        # {task index: exit code} of the tasks that finished
+        exit_codes = {}
+        try:
+            with open("{}.{}".format(self.status_filename(), self.moab_job_id), "rt") as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        exit_codes[int(fields[0])] = int(fields[1])
+        except (OSError, ValueError):
+            pass
+        return exit_codes
+
+    def element_state(self, element, state, exit_code):
+        if state not in PipelineMonitor.FINISHED_STATES:
+            return state, exit_code
+        # a task without exit code did not run (the job was cancelled or killed)
+        task_exit_code = self.task_exit_codes().get(element.array_index, exit_code if exit_code else None)
+        if task_exit_code is not None and task_exit_code != 0:
+            return PipelineMonitor.FAILED, task_exit_code
+        return PipelineMonitor.COMPLETED, task_exit_code
 
 
 class Pipeline:
-    def __init__(self, name, join_command_arguments=False, arguments=None, abort_jobs_on_exception=True):
+    def __init__(self, name, join_command_arguments=False, arguments=None, abort_jobs_on_exception=True, backend=None, max_concurrency=16):
         self.name = name
         self.join_command_arguments = join_command_arguments
-        self.arguments = arguments if arguments is not None else Arguments({})
+        self.arguments = arguments if arguments is not None else Arguments()
         self.jobs = []
-        self.debug_file = None
+        self.job_arrays = []
+        self.logger = None
         self.abort_jobs_on_exception = abort_jobs_on_exception
+        self.backend = backend if backend is not None else MoabBackend()
+        self.backend.attach(self)
+        self.sessions = None
+        self.journal = None
+        self.previous_runs = {}
+        self.runtime_history = RuntimeHistory()
+        self.metrics = None
+        self.metrics_filename = None
+        self.status_cache = None
+        self.throttle = SubmissionThrottle()
+        # pool of the local steps of run_async and run_many, and the futures
+        # of the steps that did not end yet
+        self.local_pool = None
+        self.local_steps = set()
+        self.resource_history = None
+        self.staging = None
+        # scheduler commands running at the same time on the asyncio API
+        self.max_concurrency = max_concurrency
+        self.__semaphore = None
+        self.__monitor = None
+
+    @property
+    def monitor(self):
+        if self.__monitor is None:
+            interval = self.backend.min_poll_interval
+            self.__monitor = PipelineMonitor(self, min_interval=interval, max_interval=max(300, interval))
+        return self.__monitor
+
+    def open_session(self, size=1, timeout=60, shell="/bin/bash"):
+        # Runs the scheduler commands of 'exec_command' on 'size' long-lived
+        # shells instead of starting a new shell for every command
+        if self.sessions is not None:
+            raise Exception("The sessions are already open")
+        self.sessions = queue.Queue()
+        for i in range(size):
+            self.sessions.put(CommandSession(shell=shell, timeout=timeout))
 
-    def debug_to_filename(self, filename, create_parent_folders=False):
-        if self.debug_file is not None:
+    def close_session(self):
+        if self.sessions is None:
+            return
+        sessions = self.sessions
+        self.sessions = None
+        while not sessions.empty():
+            sessions.get().close()
+
+    def debug_to_filename(self, filename, create_parent_folders=False, level="I", json_lines=False, max_bytes=None, backup_count=3):
+        # The messages are written by a background thread (see PipelineLogger);
+        # level "D" also logs the stdin of the scheduler commands
+        if self.logger is not None:
             raise Exception("Cannot debug to more than one file")
         eff_filename = self.parse_string(filename)
         if create_parent_folders:
             parent = pathlib.Path(eff_filename).parent
             parent.mkdir(parents=True, exist_ok=True)
 
-        self.debug_file = open(eff_filename, "wt")
+        self.logger = PipelineLogger(eff_filename, level=level, json_lines=json_lines, max_bytes=max_bytes, backup_count=backup_count, name=self.name)
+
+    def use_status_cache(self, filename=None, ttl=30):
+        # the job states are shared with the other questpipe processes of
+        # the user for 'ttl' seconds (see StatusCache)
+        self.status_cache = StatusCache(filename, ttl=ttl)
+        return self.status_cache
+
+    def enable_metrics(self, filename=None):
+        # Collects the latencies of the scheduler commands, submissions,
+        # rendering and state I/O. They are stored as JSON on 'filename' (or
+        # next to the state saved with 'save_state') when the pipeline ends
+        if self.metrics is None:
+            self.metrics = Metrics()
+        if filename is not None:
+            self.metrics_filename = self.parse_string(filename)
+        return self.metrics
+
+    def save_metrics(self, filename=None):
+        if self.metrics is None:
+            return None
+        if filename is not None:
+            eff_filename = self.parse_string(filename)
+        elif self.metrics_filename is not None:
+            eff_filename = self.metrics_filename
+        elif self.journal is not None:
+            eff_filename = Metrics.default_filename(self.journal.filename)
+        else:
+            return None
+        self.metrics.save(eff_filename)
+        return eff_filename
 
     def log(self, str):
-        if self.debug_file is not None:
-            self.debug_file.write("{}\n".format(str))
-            self.debug_file.flush()
+        if self.logger is not None:
+            self.logger.log(str)
+
+    def __log_command(self, eff_command, input):
+        self.log("I: {}".format(eff_command))
+        if input is not None and self.logger is not None and self.logger.level == 0:
+            self.log("D: {} stdin: {}".format(eff_command, input))
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if self.debug_file is not None:
-            self.debug_file.close()
+        try:
+            if self.local_pool is not None:
+                # the steps already started end; the rest are cancelled on an
+                # exception. Otherwise the steps waiting for others ('after')
+                # are started before the pool is shut down
+                if exc_type is None:
+                    wait(list(self.local_steps))
+                self.local_pool.shutdown(wait=True, cancel_futures=exc_type is not None)
+            self.close_session()
+            if exc_type is not None:
+                if self.abort_jobs_on_exception:
+                    self.log("E: Aborting all the jobs (exception raised)")
+                    self.abort()
+            if self.journal is not None:
+                self.journal.write_snapshot(self.to_json)
+                self.journal.close()
+            if self.metrics is not None:
+                for line in self.metrics.summary().splitlines():
+                    self.log("I: {}".format(line))
+                self.save_metrics()
+        finally:
+            # the queued messages are written even if aborting fails
+            if self.logger is not None:
+                self.logger.close()
         if exc_type is not None:
-            if self.abort_jobs_on_exception:
-                self.log("E: Aborting all the jobs (exception raised)")
-                self.abort()
             return None
         return self
 
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # aborting and saving the state block, so they run on a thread
+        return await asyncio.get_running_loop().run_in_executor(None, self.__exit__, exc_type, exc_value, traceback)
+
     @staticmethod
-    def load_state(filename):
+    def state_filename(filename):
+        # 'load_state' also accepts the folder of 'pipeline.json'
         if os.path.isdir(filename):
-            filename = "{}/pipeline.json".format(filename)
+            return "{}/pipeline.json".format(filename)
+        return filename
+
+    @staticmethod
+    def load_state(filename, backend=None, metrics=False):
+        start = time.perf_counter()
+        filename = Pipeline.state_filename(filename)
         with open(filename, "rt") as f:
             data = json.loads(f.read())
-        return Pipeline.from_json(data)
+        pipeline = Pipeline.from_json(data, backend)
+        # transitions recorded after the last snapshot (e.g. when the process
+        # submitting the pipeline was interrupted)
+        pipeline.replay(StateJournal.read(filename))
+        if metrics:
+            pipeline.enable_metrics().add("load_state", time.perf_counter() - start)
+        return pipeline
 
     @staticmethod
-    def from_json(data):
+    def from_json(data, backend=None):
         name = data["name"]
         join_command_arguments = data["join_command_arguments"]
         arguments = Arguments.from_json(data["arguments"])
-        msub_arguments = arguments.get("msub_arguments", [])
-        pipeline = Pipeline(name, join_command_arguments, arguments)
-        jobs = [(d.get("dependences", []), d.get("notokdependences", []), MJob.from_json(pipeline, msub_arguments, d)) for d in data["jobs"]]
-        job_ids = {job.moab_job_id: job for _, _, job in jobs}
-        for dependences, notokdependences, job in jobs:
-            job.dependences = [job_ids[dependence] for dependence in dependences]
-            job.notokdependences = [job_ids[dependence] for dependence in notokdependences]
-        pipeline.jobs = [job for (dependence, notokdependence, job) in jobs]
+        pipeline = Pipeline(name, join_command_arguments, arguments, backend=backend)
+        loaded = [(d, pipeline.__add_loaded_job(d, True)) for d in data.get("job_arrays", [])]
+        loaded += [(d, pipeline.__add_loaded_job(d, False)) for d in data["jobs"]]
+        refs = {job.ref: job for _, job in loaded}
+        job_ids = {job.moab_job_id: job for _, job in loaded}
+        for d, job in loaded:
+            Pipeline.__link_loaded_job(job, d, refs, job_ids)
         return pipeline
 
+    def __add_loaded_job(self, data, is_array):
+        msub_arguments = self.arguments.get("msub_arguments", [])
+        if is_array:
+            if data.get("packed", False):
+                job = MPackedJob.from_json(self, msub_arguments, data)
+            else:
+                job = MJobArray.from_json(self, msub_arguments, data)
+            job.index = len(self.job_arrays)
+            self.job_arrays.append(job)
+        else:
+            job = MJob.from_json(self, msub_arguments, data)
+            job.index = len(self.jobs)
+            self.jobs.append(job)
+            if "array" in data:
+                job.array = self.job_arrays[data["array"]]
+                job.array_index = data["array_index"]
+                job.array.elements.append(job)
+        return job
+
+    @staticmethod
+    def __link_loaded_job(job, data, refs, job_ids):
+        # older states only identify the dependences by their ids
+        if "dependence_refs" in data:
+            job.dependences = [refs[ref] for ref in data["dependence_refs"]]
+        else:
+            job.dependences = [job_ids[dependence] for dependence in data.get("dependences", [])]
+        if "notokdependence_refs" in data:
+            job.notokdependences = [refs[ref] for ref in data["notokdependence_refs"]]
+        else:
+            job.notokdependences = [job_ids[dependence] for dependence in data.get("notokdependences", [])]
+
+    def replay(self, records):
+        refs = {job.ref: job for job in self.job_arrays + self.jobs}
+        for record in records:
+            ref = record["ref"]
+            if record["event"] == "created":
+                if ref not in refs:
+                    job = self.__add_loaded_job(record["data"], ref.startswith("a"))
+                    Pipeline.__link_loaded_job(job, record["data"], refs, {})
+                    refs[ref] = job
+                continue
+            job = refs[ref]
+            if record["event"] == "dependences":
+                Pipeline.__link_loaded_job(job, record["data"], refs, {})
+                continue
+            for key in ["moab_job_name", "moab_job_id", "status", "command", "exit_code", "fingerprint", "started", "finished", "usage", "skip_reason"]:
+                if key in record:
+                    setattr(job, key, record[key])
+            if record["event"] == "submitted":
+                job.on_submitted()
+            if "status" in record:
+                job.set_status(record["status"])
+
     def to_json(self):
         return {
             "name": self.name,
             "join_command_arguments": self.join_command_arguments,
             "arguments": self.arguments.to_json(),
+            "job_arrays": [job_array.to_json() for job_array in self.job_arrays],
             "jobs": [job.to_json() for job in self.jobs]}
 
-    def save_state(self, filename):
+    def save_state(self, filename, journal=True, compact_every=1000, sync=False):
+        # Writes the whole state and, with 'journal', appends every following
+        # job transition to 'filename.journal' until the next save_state
         eff_filename = self.parse_string(filename)
-        with open(eff_filename, "wt") as f:
-            f.write(json.dumps(
-                self.to_json(), 
-                sort_keys=True, 
-                indent=4, 
+        if self.metrics is not None:
+            with self.metrics.timer("save_state"):
+                return self.__save_state(eff_filename, journal, compact_every, sync)
+        return self.__save_state(eff_filename, journal, compact_every, sync)
+
+    def __save_state(self, eff_filename, journal, compact_every, sync):
+        if not journal:
+            if self.journal is not None and self.journal.filename == eff_filename:
+                self.journal.close()
+                self.journal = None
+            write_atomically(eff_filename, json.dumps(
+                self.to_json(),
+                sort_keys=True,
+                indent=4,
                 separators=(',', ': ')))
+            # an older journal would be replayed on top of this snapshot
+            journal_filename = StateJournal.journal_filename(eff_filename)
+            if os.path.exists(journal_filename):
+                os.remove(journal_filename)
+            return eff_filename
+        if self.journal is None or self.journal.filename != eff_filename:
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = StateJournal(eff_filename, compact_every=compact_every, sync=sync)
+        self.journal.write_snapshot(self.to_json)
         return eff_filename
 
-    def checkjobs(self):
-        # If the job is not appearing on 'showq', it means, the job is done
-        job_ids = [job.moab_job_id for job in self.jobs]
+    def record(self, event, job, **fields):
+        journal = self.journal
+        if journal is None:
+            return
+        fields["event"] = event
+        fields["ref"] = job.ref
+        if journal.append(fields):
+            journal.write_snapshot(self.to_json)
 
-        QUEUE_STATES = "HQTWS"
-        RUNNING_STATES = "R"
+    def reuse_state(self, filename):
+        # The jobs of the saved state that completed are not submitted again
+        # if they are up to date (see 'is_up_to_date')
+        previous = Pipeline.load_state(self.parse_string(filename))
+        for job in previous.job_arrays + previous.jobs:
+            if job.fingerprint is not None and job.is_finished:
+                self.previous_runs[job.fingerprint] = job
+        self.log("I: {} jobs of {} can be reused".format(len(self.previous_runs), filename))
+        self.runtime_history.add_pipeline(previous)
 
-        queue_count = 0
-        running_count = 0
-        completed_count = 0
+    def load_runtimes(self, filename):
+        # the runtimes observed on a previous run are used as estimates of
+        # the jobs with the same name (see critical_path)
+        self.runtime_history.add_pipeline(Pipeline.load_state(self.parse_string(filename)))
 
-        p = subprocess.Popen("qstat", stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        stdout, stderr = p.communicate()
+    def use_staging(self, directory, link="hard"):
+        # the inputs staged by the jobs (see MJob.stage) are copied once to
+        # 'directory' and linked from there on every run
+        self.staging = StagingCache(self.parse_string(directory), link=link)
+        return self.staging
 
-        is_header = True
-        for line in stdout.splitlines():
-            line = line.decode("utf8")
-            if line.endswith('\n'):
-                line = line[:-1]
-            line = line.strip()
-            if len(line) == 0:
-                continue
-            if is_header:
-                if re.match("^[- ]*$", line):
-                    is_header = False
-                continue
+    def use_resource_history(self, filename=None, keep=100):
+        # the resources used by the jobs that finish are added to a history
+        # shared by all the pipelines of the user (see autosize)
+        self.resource_history = ResourceHistory(self.parse_string(filename) if filename is not None else None, keep=keep)
+        return self.resource_history
 
-            line = re.sub("\s+", " ", line)
-            params = line.split(" ")
-            if len(params) < 5:
+    def autosize(self, percentile=90, margin=1.2, min_samples=3, walltime=True, ppn=True):
+        # The walltime and ppn of the jobs not submitted yet are the
+        # 'percentile' of the ones used by the last jobs with the same name
+        # template, plus a 'margin', so they fit on the backfill windows. The
+        # templates with less than 'min_samples' finished jobs are not changed
+        history = self.resource_history if self.resource_history is not None else ResourceHistory()
+        templates = history.load()
+        sized = 0
+        for job in self.job_arrays + self.jobs:
+            if job.array is not None or job.moab_job_id is not None:
                 continue
-            job_id = params[0].split(".")[0]
-            if job_id not in job_ids:
+            usages = templates.get(job.name, [])
+            if isinstance(job, MPackedJob) or len(usages) < min_samples:
                 continue
-            state = params[4]
-    
-            if state in QUEUE_STATES:
-                queue_count += 1
-            elif state in RUNNING_STATES:
-                running_count += 1
-            else:
-                completed_count += 1
+            estimate = ResourceHistory.estimate(usages, percentile, margin)
+            if walltime and estimate["walltime"] is not None:
+                job.walltime = estimate["walltime"]
+            if ppn and estimate["ppn"] is not None:
+                job.ppn = estimate["ppn"]
+            sized += 1
+        self.log("I: {} jobs sized from {}".format(sized, history.filename))
+        return sized
 
-        remain = len(job_ids) - (queue_count + running_count + completed_count)
-        completed_count += remain
-        return queue_count, running_count, completed_count
+    def critical_path(self, default_runtime=3600):
+        # analysis of the jobs of the pipeline with the estimated runtimes
+        jobs = [job for job in self.job_arrays + self.jobs if job.array is None]
+        runtimes = {id(job): job.estimate_runtime(self.runtime_history, default_runtime) for job in jobs}
+        return CriticalPath(jobs, runtimes)
 
-    def abort(self):
-        job_states = {job.moab_job_id: MJob.COMPLETED for job in self.jobs}  
-        for job in self.jobs:
-            p = subprocess.Popen("mjobctl -c {}".format(job.moab_job_id), stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-            stdout, stderr = p.communicate()
-            if len(stdout) > 0:
-                self.log("I: abort says: {}".format(stdout))
-            if len(stderr) > 0:
-                self.log("E: abort failed: {}".format(stderr))
+    def prioritize(self, critical_path=None, max_priority=1000, walltime_margin=1.5, critical_walltime_margin=2.0):
+        # The jobs without slack get priority 0 and the rest less (down to
+        # -'max_priority'), the more slack they have: MOAB only accepts
+        # positive user priorities with ENABLEPOSUSERPRIORITY. The walltime
+        # is the estimated runtime plus a margin, larger on the critical path:
+        # a critical job that is killed delays the whole pipeline. The jobs
+        # without a runtime (given or seen on previous runs) keep the
+        # walltime of their 'msub_arguments'
+        if critical_path is None:
+            critical_path = self.critical_path()
+        makespan = max(critical_path.makespan, 1)
+        for job in critical_path.jobs:
+            job.priority = -int(round(max_priority * critical_path.slack(job) / makespan))
+            if job.has_runtime_estimate(self.runtime_history):
+                margin = critical_walltime_margin if critical_path.is_critical(job) else walltime_margin
+                job.walltime = int(math.ceil(critical_path.runtimes[id(job)] * margin / 60)) * 60
+        self.log("I: critical path of {} jobs, expected makespan {}".format(len(critical_path.path), format_seconds(critical_path.makespan)))
+        return critical_path
+
+    def is_up_to_date(self, job):
+        if job.fingerprint is None or job.fingerprint not in self.previous_runs:
+            return False
+        previous = self.previous_runs[job.fingerprint]
+        if previous.is_not_needed:
+            # it never ran
+            return False
+        if previous.status != MJob.SKIPPED:
+            exit_codes = previous.exit_codes
+            if any(exit_code is not None and exit_code != 0 for exit_code in exit_codes):
+                return False
+            # without exit codes (cancelled or not monitored) the outputs decide
+            if any(exit_code is None for exit_code in exit_codes) and len(job.outputs) == 0:
+                return False
+        # like make: every output exists and it is newer than every input
+        outputs = []
+        for pattern in job.render_files(job.outputs):
+            filenames = glob.glob(pattern)
+            if len(filenames) == 0:
+                return False
+            outputs.extend(filenames)
+        inputs = []
+        for pattern in job.render_files(job.inputs):
+            filenames = glob.glob(pattern)
+            if len(filenames) == 0:
+                return False
+            inputs.extend(filenames)
+        if len(outputs) > 0 and len(inputs) > 0:
+            oldest_output = min(os.stat(filename).st_mtime_ns for filename in outputs)
+            newest_input = max(os.stat(filename).st_mtime_ns for filename in inputs)
+            if newest_input > oldest_output:
+                return False
+        return True
+
+    def checkjobs(self, force=False):
+        # returns the (queued, running, completed) counts; 'states' of the
+        # result maps the id of every submitted job to its state. With a
+        # status cache, 'force' asks the scheduler even if the cache is fresh
+        monitor = self.monitor
+        if self.metrics is not None:
+            with self.metrics.timer("checkjobs"):
+                monitor.poll(force)
+        else:
+            monitor.poll(force)
+        return monitor.counts()
+
+    def query_states(self, job_ids, force=False):
+        if self.metrics is not None:
+            with self.metrics.timer("query_states"):
+                return self.__query_states(job_ids, force)
+        return self.__query_states(job_ids, force)
+
+    def __query_states(self, job_ids, force):
+        # None when the scheduler cannot be asked
+        try:
+            if self.status_cache is not None:
+                return self.status_cache.query(job_ids, self.backend.query_states, force)
+            return self.backend.query_states(job_ids)
+        except SchedulerError as e:
+            self.log("E: cannot query the states of the jobs: {}".format(e))
+            return None
+
+    def abort(self, max_workers=8):
+        # Cancels the jobs still queued or running on the scheduler, using a
+        # single status query to find them. The dependants are cancelled
+        # before their dependences (leaf first), so no job starts because
+        # its dependence was cancelled in the meantime
+        submitted = [job for job in self.job_arrays + self.jobs if job.array is None and job.moab_job_id is not None and not job.is_finished]
+        if len(submitted) == 0:
+            return []
+        self.monitor.poll()
+        live = [job for job in submitted if not job.is_finished]
+        self.log("I: aborting {} jobs of {} submitted".format(len(live), len(submitted)))
+
+        cancelled = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for level in reversed(dependence_levels(live)):
+                for job, error in zip(level, executor.map(self.__cancel_job, level)):
+                    if error is None:
+                        cancelled.append(job)
+                    else:
+                        self.log("E: abort of {} ({}) failed: {}".format(job.name, job.moab_job_id, error))
+        return cancelled
+
+    def __cancel_job(self, job):
+        try:
+            self.backend.cancel(job.scheduler_job_id)
+        except SchedulerError as e:
+            return e
+        job.set_status(MJob.COMPLETED)
+        self.record("cancelled", job, status=job.status)
+        return None
 
-    def exec_command(self, command, command_arguments, input=None):
+    def exec_command(self, command, command_arguments, input=None, timeout=None):
+        _, stdout, stderr, returncode = self.exec_command_status(command, command_arguments, input, timeout)
+        return None, stdout, stderr
+
+    def exec_command_status(self, command, command_arguments, input=None, timeout=None):
+        # like exec_command, with the exit code of the command. After 'timeout'
+        # seconds the command is killed (negative exit code)
+        if self.metrics is not None:
+            with self.metrics.timer("exec_command.{}".format(command)):
+                result = self.__exec_command_status(command, command_arguments, input, timeout)
+            if result[3] != 0:
+                self.metrics.count("exec_command.{}.errors".format(command))
+            return result
+        return self.__exec_command_status(command, command_arguments, input, timeout)
+
+    def __exec_command_status(self, command, command_arguments, input, timeout):
         if command_arguments is None:
             command_arguments = []
             
@@ -339,18 +1262,173 @@ class Pipeline:
         else:
             eff_command = [command] + command_arguments
 
-        self.log("I: {} / {}".format(eff_command, input if input is not None else "None"))
+        self.__log_command(eff_command, input)
+        sessions = self.sessions
+        if sessions is not None:
+            session = sessions.get()
+            try:
+                stdout, stderr, returncode = session.run(" ".join([command] + command_arguments), input, timeout)
+            except SessionError as e:
+                self.log("E: session failed running {}: {}".format(eff_command, e))
+                stdout, stderr, returncode = b"", bytes("questpipe session: {}".format(e), "utf-8"), -1
+            finally:
+                sessions.put(session)
+            return None, stdout, stderr, returncode
         if input is not None:
-            p = subprocess.Popen(eff_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-            stdout, stderr = p.communicate(bytes(input, "utf-8"))
-            return None, stdout, stderr
+            p = subprocess.Popen(eff_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, start_new_session=timeout is not None)
+            stdout, stderr = self.__communicate(p, eff_command, bytes(input, "utf-8"), timeout)
+            return None, stdout, stderr, p.returncode
         else:
-            p = subprocess.Popen(eff_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+            p = subprocess.Popen(eff_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, start_new_session=timeout is not None)
+            stdout, stderr = self.__communicate(p, eff_command, None, timeout)
+            return None, stdout, stderr, p.returncode
+
+    def __communicate(self, p, eff_command, input, timeout):
+        try:
+            return p.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.log("E: {} killed after {} seconds".format(eff_command, timeout))
+            kill_process(p)
             stdout, stderr = p.communicate()
-            return None, stdout, stderr
+            return stdout, stderr + bytes("questpipe: killed after {} seconds\n".format(timeout), "utf-8")
+
+    async def exec_command_async(self, command, command_arguments, input=None, timeout=None):
+        # asyncio version of exec_command_status: at most 'max_concurrency'
+        # commands of the pipeline run at the same time
+        if command_arguments is None:
+            command_arguments = []
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self.__semaphore:
+            if self.sessions is not None:
+                return await asyncio.get_running_loop().run_in_executor(None, self.exec_command_status, command, command_arguments, input, timeout)
+
+            start = time.perf_counter()
+            if self.join_command_arguments:
+                eff_command = " ".join([command] + command_arguments)
+                self.__log_command(eff_command, input)
+                p = await asyncio.create_subprocess_shell(
+                    eff_command,
+                    stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=timeout is not None)
+            else:
+                eff_command = [command] + command_arguments
+                self.__log_command(eff_command, input)
+                p = await asyncio.create_subprocess_exec(
+                    *eff_command,
+                    stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=timeout is not None)
+            try:
+                stdout, stderr = await asyncio.wait_for(p.communicate(bytes(input, "utf-8") if input is not None else None), timeout)
+            except asyncio.TimeoutError:
+                self.log("E: {} killed after {} seconds".format(eff_command, timeout))
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                await p.wait()
+                stdout, stderr = b"", bytes("questpipe: killed after {} seconds\n".format(timeout), "utf-8")
+
+        if self.metrics is not None:
+            self.metrics.add("exec_command.{}".format(command), time.perf_counter() - start)
+            if p.returncode != 0:
+                self.metrics.count("exec_command.{}.errors".format(command))
+        return None, stdout, stderr, p.returncode
+
+    def stream_command(self, command, command_arguments, input=None, timeout=None, on_line=None, on_stderr_line=None, tail_lines=100):
+        # Like exec_command, but the lines of stdout are read while the command
+        # runs instead of keeping the whole output in memory (see CommandStream)
+        if command_arguments is None:
+            command_arguments = []
+        if self.sessions is not None:
+            # the sessions return the whole output
+            _, stdout, stderr, returncode = self.exec_command_status(command, command_arguments, input, timeout)
+            stream = CommandStream.from_output(stdout, stderr, returncode)
+            stream.on_line = on_line
+            return stream
+
+        if self.join_command_arguments:
+            eff_command = " ".join([command] + command_arguments)
+        else:
+            eff_command = [command] + command_arguments
+        self.__log_command(eff_command, input)
+        start = time.perf_counter()
+
+        def on_finished(stream):
+            if len(stream.stderr) > 0:
+                self.log("E: {} says: {}".format(command, stream.stderr))
+            if self.metrics is not None:
+                self.metrics.add("exec_command.{}".format(command), time.perf_counter() - start)
+                if stream.returncode != 0:
+                    self.metrics.count("exec_command.{}.errors".format(command))
+        return CommandStream(eff_command, on_finished, input=input, timeout=timeout, tail_lines=tail_lines, on_line=on_line, on_stderr_line=on_stderr_line)
+
+    def create_job(self, name, local_arguments=None, dependences=None, notokdependences=None, workdir=None, outdir=None, errdir=None, command=None, hold=False, inputs=None, outputs=None, runtime=None):
+        arguments = self.arguments.combine(local_arguments)
+        msub_arguments = arguments.get("msub_arguments", [])
+        if dependences is None:
+            dependences = []
+        if workdir is None:
+            workdir = arguments.get("workdir", ".")
+        if outdir is None:
+            outdir = arguments.get("outdir", ".")
+        if errdir is None:
+            errdir = arguments.get("errdir", ".")
+        job = MJob.create_new(self, name, msub_arguments, dependences, notokdependences, workdir, outdir, errdir, arguments)
+        job.command = command
+        job.hold = hold
+        job.inputs = inputs if inputs is not None else []
+        job.outputs = outputs if outputs is not None else []
+        job.runtime = runtime
+        job.index = len(self.jobs)
+        self.jobs.append(job)
+        self.record("created", job, data=job.to_json())
+        return job
+
+    def scatter_gather(self, name, input, command, output, gather_command, local_arguments=None, dependences=None, chunks=None, chunk_bytes=1 << 30, max_chunks=32, chunk_prefix=None, chunk_suffix=".fastq.gz", record_lines=4, keep_chunks=False, runtime=None):
+        # Splits 'input' (a FASTQ, or records of 'record_lines' lines) in
+        # chunks on a '<name>_split' job, runs 'command' on every chunk on the
+        # jobs '<name>_<chunk_index>' and merges their outputs with
+        # 'gather_command' on the job 'name', that is returned (with the rest,
+        # see ScatterGather). The commands see the arguments {chunk_index},
+        # {chunks}, {chunk} (the input chunk), {chunk_output} ('output' of the
+        # chunk) and, on the gather job, {chunk_outputs} (all of them). The
+        # number of chunks is one for every 'chunk_bytes' of the input, unless
+        # it is given in 'chunks' (needed when the input does not exist yet).
+        # The input chunks are removed once gathered, unless 'keep_chunks'
+        arguments = self.arguments.combine(local_arguments)
+        eff_input = arguments.resolver().render(input)
+        if chunks is None:
+            if not os.path.exists(eff_input):
+                raise Exception("Cannot size the chunks of {}: it does not exist (give the number of chunks)".format(eff_input))
+            chunks = chunk_count(eff_input, chunk_bytes, max_chunks)
+        if chunk_prefix is None:
+            chunk_prefix = "{{outdir}}/{}.chunk".format(name)
+        values = dict(arguments.values, scatter_input=input, chunks=str(chunks), chunk_prefix=chunk_prefix, chunk_suffix=chunk_suffix)
+        split = self.create_job(
+            "{}_split".format(name), Arguments(**values), dependences=dependences,
+            command=split_records_command(chunks, record_lines, chunk_suffix.endswith(".gz")), inputs=[input])
 
-    def create_job(self, name, local_arguments=None, dependences=None, notokdependences=None, workdir=None, outdir=None, errdir=None):
-        self.arguments = self.arguments.combine(local_arguments)
+        chunk_jobs = []
+        for index in range(chunks):
+            chunk_values = dict(values, chunk_index=str(index), chunk="{{chunk_prefix}}{}{{chunk_suffix}}".format(index), chunk_output=output)
+            chunk_jobs.append(self.create_job(
+                "{}_{{chunk_index}}".format(name), Arguments(**chunk_values), dependences=[split],
+                command=command, outputs=[output], runtime=runtime))
+
+        # rendered here: the values are not templates on the gather job
+        chunk_outputs = " ".join('"{}"'.format(job.parse_string(output)) for job in chunk_jobs)
+        chunk_inputs = " ".join('"{}"'.format(job.parse_string("{chunk}")) for job in chunk_jobs)
+        gather_values = dict(values, chunk_outputs=chunk_outputs.replace("{", "{{").replace("}", "}}"))
+        if not keep_chunks:
+            gather_command = "( {}\n) && rm -f {}".format(gather_command, chunk_inputs.replace("{", "{{").replace("}", "}}"))
+        gather = self.create_job(
+            name, Arguments(**gather_values), dependences=chunk_jobs,
+            command=gather_command, inputs=[job.parse_string(output) for job in chunk_jobs])
+        self.log("I: {} split in {} chunks".format(name, chunks))
+        return ScatterGather(split, chunk_jobs, gather)
+
+    def create_job_array(self, name, elements_arguments, dependences=None, notokdependences=None, workdir=None, outdir=None, errdir=None, command=None, hold=False, inputs=None, outputs=None, runtime=None):
         msub_arguments = self.arguments.get("msub_arguments", [])
         if dependences is None:
             dependences = []
@@ -360,21 +1438,270 @@ class Pipeline:
             outdir = self.arguments.get("outdir", ".")
         if errdir is None:
             errdir = self.arguments.get("errdir", ".")
-        job = MJob.create_new(self, name, msub_arguments, dependences, notokdependences, workdir, outdir, errdir, self.arguments)
-        self.jobs.append(job)
-        return job
+        if len(elements_arguments) == 0:
+            raise Exception("Job array {} has no elements".format(name))
+        job_array = MJobArray(self, name, msub_arguments, dependences, notokdependences, workdir, outdir, errdir, self.arguments, None, None, MJob.CREATED, command, [])
+        return self.__add_job_group(job_array, elements_arguments, hold, inputs, outputs, runtime)
 
-    def parse_string(self, value, max_recursive_loops=10):
-        for i in range(max_recursive_loops):
-            new_value = value.format(**self.arguments.values)
-            if new_value != value:
-                value = new_value
+    def create_packed_job(self, name, tasks_arguments, dependences=None, notokdependences=None, workdir=None, outdir=None, errdir=None, command=None, hold=False, inputs=None, outputs=None, ppn=None, task_walltime=None, runtime=None):
+        # Like create_job_array, but all the tasks run on a single job with
+        # 'ppn' cores (by default, one for each task up to 'num_processors').
+        # 'task_walltime' (seconds of the longest task) sizes the walltime
+        msub_arguments = self.arguments.get("msub_arguments", [])
+        if dependences is None:
+            dependences = []
+        if workdir is None:
+            workdir = self.arguments.get("workdir", ".")
+        if outdir is None:
+            outdir = self.arguments.get("outdir", ".")
+        if errdir is None:
+            errdir = self.arguments.get("errdir", ".")
+        if len(tasks_arguments) == 0:
+            raise Exception("Packed job {} has no tasks".format(name))
+        if ppn is None:
+            ppn = min(len(tasks_arguments), int(self.arguments.get("num_processors", 1)))
+        packed_job = MPackedJob(self, name, msub_arguments, dependences, notokdependences, workdir, outdir, errdir, self.arguments, None, None, MJob.CREATED, command, [], ppn, task_walltime)
+        return self.__add_job_group(packed_job, tasks_arguments, hold, inputs, outputs, runtime)
+
+    def __add_job_group(self, job_array, elements_arguments, hold, inputs, outputs, runtime):
+        # 'runtime' is the estimated runtime of every element
+        job_array.hold = hold
+        job_array.runtime = runtime
+        job_array.inputs = inputs if inputs is not None else []
+        job_array.outputs = outputs if outputs is not None else []
+        job_array.index = len(self.job_arrays)
+        self.job_arrays.append(job_array)
+        self.record("created", job_array, data=job_array.to_json())
+        for index, local_arguments in enumerate(elements_arguments):
+            element = MJob.create_new(self, "{}_{}".format(job_array.name, index), job_array.msub_arguments, [], [], job_array.workdir, job_array.outdir, job_array.errdir, self.arguments.combine(local_arguments))
+            element.array = job_array
+            element.array_index = index
+            element.index = len(self.jobs)
+            job_array.elements.append(element)
+            self.jobs.append(element)
+            self.record("created", element, data=element.to_json())
+        return job_array
+
+    def submit_all(self, max_workers=8, NUMBER_OF_ATTEMPTS=3, max_fan_in=64):
+        # Submits the jobs declared with a command in 'create_job', level by level:
+        # the jobs of a level only depend on jobs of previous levels, so they are
+        # sent to the scheduler at the same time once the previous level has its ids
+        self.reduce_dependences(self.__declared_jobs(), max_fan_in)
+        pending = self.__declared_jobs()
+        levels = dependence_levels(pending)
+        self.log("I: submitting {} jobs in {} levels".format(len(pending), len(levels)))
+        held = self.__held_jobs(pending, levels[0] if len(levels) > 0 else [])
+        held_ids = set(id(job) for job in held)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for level in levels:
+                futures = [
+                    executor.submit(job.launch, True if id(job) in held_ids else None, NUMBER_OF_ATTEMPTS)
+                    for job in level]
+                for future in futures:
+                    future.result()
+
+        for job in held:
+            if job.status != MJob.SKIPPED:
+                job.unhold()
+        return pending
+
+    async def submit(self, NUMBER_OF_ATTEMPTS=3, max_fan_in=64):
+        # asyncio version of submit_all: every job is sent to the scheduler as
+        # soon as its dependences have their ids, so independent branches do
+        # not wait for each other
+        self.reduce_dependences(self.__declared_jobs(), max_fan_in)
+        pending = self.__declared_jobs()
+        pending_ids = set(id(job) for job in pending)
+        roots = [job for job in pending if all(id(parent) not in pending_ids for parent in job_parents(job))]
+        held = self.__held_jobs(pending, roots)
+        held_ids = set(id(job) for job in held)
+        self.log("I: submitting {} jobs".format(len(pending)))
+        await asyncio.gather(*(job.submit(True if id(job) in held_ids else None, NUMBER_OF_ATTEMPTS) for job in pending))
+        loop = asyncio.get_running_loop()
+        for job in held:
+            if job.status != MJob.SKIPPED:
+                await loop.run_in_executor(None, job.unhold)
+        return pending
+
+    async def wait(self):
+        # asyncio version of monitor.wait: several pipelines can be followed
+        # from the same event loop
+        monitor = self.monitor
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.run_in_executor(None, monitor.poll)
+            if monitor.is_finished:
+                return monitor.counts()
+            await asyncio.sleep(monitor.interval)
+
+    def reduce_dependences(self, jobs, max_fan_in=64):
+        # Removes the dependences implied by other dependences (transitive
+        # reduction) and, when a job still depends on more than 'max_fan_in'
+        # jobs (None: no limit), it waits for a tree of no-op barrier jobs
+        # instead: the dependence lists of msub stay short
+        dependence_levels(jobs)   # fails on cycles
+        ancestors = AfterokAncestors()
+        for job in jobs:
+            dependences = job.dependences
+            notokdependences = job.notokdependences or []
+            if len(dependences) > 1:
+                dependences = reduced_dependences(job, ancestors)
+            if max_fan_in is not None and len(dependences) > max_fan_in:
+                dependences = self.__barriers(job, dependences, max_fan_in, False)
+            if max_fan_in is not None and len(notokdependences) > max_fan_in:
+                # all the barriers are ok when all the dependences failed
+                dependences = dependences + self.__barriers(job, notokdependences, max_fan_in, True)
+                notokdependences = []
+            if len(dependences) != len(job.dependences) or len(notokdependences) != len(job.notokdependences or []):
+                self.log("I: {} depends on {} jobs instead of {}".format(job.name, len(dependences) + len(notokdependences), len(job.dependences) + len(job.notokdependences or [])))
+                job.dependences = dependences
+                job.notokdependences = notokdependences
+                self.record("dependences", job, data={
+                    "dependence_refs": [parent.ref for parent in dependences],
+                    "notokdependence_refs": [parent.ref for parent in notokdependences]})
+
+    def __barriers(self, job, parents, max_fan_in, notok):
+        name = job.parse_string(job.name)
+        level = 0
+        while len(parents) > max_fan_in:
+            barriers = []
+            for i in range(0, len(parents), max_fan_in):
+                chunk = parents[i:i + max_fan_in]
+                barrier = self.create_job(
+                    "{}_barrier{}_{}".format(name, level, len(barriers)),
+                    dependences=[] if notok and level == 0 else chunk,
+                    notokdependences=chunk if notok and level == 0 else None,
+                    workdir=job.workdir, outdir=job.outdir, errdir=job.errdir,
+                    command="true")
+                barrier.ppn = 1
+                barrier.walltime = 300
+                barriers.append(barrier)
+            parents = barriers
+            level += 1
+        return parents
+
+    def __declared_jobs(self):
+        pending = [job for job in self.job_arrays + self.jobs if job.is_declared]
+        for job in pending:
+            for parent in job.dependences + (job.notokdependences or []):
+                if parent.array is not None:
+                    parent = parent.array
+                if parent.moab_job_id is None and parent.status != MJob.SKIPPED and not parent.is_declared:
+                    raise Exception("MJob {} depends on {}, which is not declared nor running".format(job.name, parent.name))
+        return pending
+
+    def __held_jobs(self, pending, roots):
+        # the roots are held until the whole graph is submitted, so no job
+        # finishes before its dependants are on the queue (see prepare_async_run)
+        parents = set(id(parent.array if parent.array is not None else parent) for job in pending for parent in job.dependences + (job.notokdependences or []))
+        return [job for job in roots if not job.hold and id(job) in parents]
+
+    def parse_string(self, value):
+        return self.arguments.resolver().render(value)
+
+    def run(self, command, timeout=None):
+        eff_command = self.parse_string(command)
+        p = subprocess.Popen(eff_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, start_new_session=timeout is not None)
+        stdout, stderr = self.__communicate(p, eff_command, None, timeout)
+        return None, stdout, stderr
+
+    def use_local_pool(self, max_workers=8, processes=False):
+        # the local steps of run_async and run_many run on 'max_workers'
+        # threads (or processes)
+        if self.local_pool is not None:
+            wait(list(self.local_steps))
+            self.local_pool.shutdown(wait=True)
+        self.local_pool = ProcessPoolExecutor(max_workers=max_workers) if processes else ThreadPoolExecutor(max_workers=max_workers)
+        return self.local_pool
+
+    def run_async(self, command, after=None, timeout=None):
+        # Runs 'command' (rendered like 'run') on the local pool when the steps
+        # of 'after' (futures of run_async) end. The future returns (None,
+        # stdout, stderr) like 'run', or raises a CommandError when the command
+        # fails or when a step of 'after' failed (then it is not run)
+        if self.local_pool is None:
+            self.use_local_pool()
+        eff_command = self.parse_string(command)
+        after = list(after) if after is not None else []
+        future = Future()
+        self.local_steps.add(future)
+        future.add_done_callback(self.local_steps.discard)
+
+        def on_finished(step):
+            try:
+                _, stdout, stderr, returncode = step.result()
+            except Exception as e:
+                future.set_exception(e)
+                return
+            if returncode != 0:
+                self.log("E: {} exit code {}: {}".format(eff_command, returncode, stderr))
+                future.set_exception(CommandError([(eff_command, returncode, stderr.decode("utf-8", "replace"))]))
             else:
-                return new_value
-        raise Exception("recursive parsing")
+                future.set_result((None, stdout, stderr))
+
+        def start():
+            failed = [previous for previous in after if previous.cancelled() or previous.exception() is not None]
+            if len(failed) > 0:
+                future.set_exception(CommandError([(eff_command, None, "not run: {} previous steps failed".format(len(failed)))]))
+                return
+            self.log("I: {}".format(eff_command))
+            try:
+                step = self.local_pool.submit(run_command, eff_command, timeout)
+            except RuntimeError as e:
+                # the pool is shut down
+                future.set_exception(e)
+                return
+            step.add_done_callback(on_finished)
+
+        pending = [len(after)]
+        lock = threading.Lock()
 
-    def run(self, command):
+        def on_previous_finished(previous):
+            with lock:
+                pending[0] -= 1
+                ready = pending[0] == 0
+            if ready:
+                start()
+
+        if len(after) == 0:
+            start()
+        for previous in after:
+            previous.add_done_callback(on_previous_finished)
+        return future
+
+    def run_many(self, commands, after=None, timeout=None):
+        # Runs the 'commands' side by side (after the steps of 'after') and
+        # waits for all of them. Returns the (None, stdout, stderr) of every
+        # command; the failures are raised together in one CommandError
+        futures = [self.run_async(command, after, timeout) for command in commands]
+        results = []
+        failures = []
+        for command, future in zip(commands, futures):
+            try:
+                results.append(future.result())
+            except CommandError as e:
+                failures += e.failures
+            except Exception as e:
+                failures.append((self.parse_string(command), None, str(e)))
+        if len(failures) > 0:
+            raise CommandError(failures)
+        return results
+
+    def run_stream(self, command, on_line=None, on_stderr_line=None, log_output=False, timeout=None, tail_lines=100):
+        # Like run, but the output is read while the command runs: iterate the
+        # returned CommandStream (or call its 'wait') to run it. Only the last
+        # 'tail_lines' lines are kept; 'log_output' writes every line on the
+        # debug file
         eff_command = self.parse_string(command)
-        p = subprocess.Popen(eff_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        stdout, stderr = p.communicate()
-        return None, stdout, stderr
\ No newline at end of file
+        if log_output:
+            on_line = self.__log_lines("I", on_line)
+            on_stderr_line = self.__log_lines("W", on_stderr_line)
+        return CommandStream(eff_command, input=None, timeout=timeout, tail_lines=tail_lines, on_line=on_line, on_stderr_line=on_stderr_line)
+
+    def __log_lines(self, level, on_line):
+        def log_line(line):
+            self.log("{}: {}".format(level, line.decode("utf-8", "replace").rstrip("\n")))
+            if on_line is not None:
+                on_line(line)
+        return log_line
\ No newline at end of file
@@ -0,0 +1,111 @@
+import json
+import math
+import os
+import time
+
+from .state import file_lock, write_atomically
+
+
+# units of the memory reported by qstat ('resources_used.mem = 123456kb')
+MEMORY_UNITS = {"b": 1, "kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3, "tb": 1024 ** 4}
+
+
+def parse_duration(value):
+    # '[[DD:]HH:]MM:SS' or seconds -> seconds
+    if value is None:
+        return None
+    seconds = 0
+    try:
+        for part in value.strip().split(":"):
+            seconds = seconds * 60 + int(part)
+    except ValueError:
+        return None
+    if value.count(":") == 3:
+        # days: DD:HH:MM:SS was multiplied by 60 instead of 24
+        days, rest = divmod(seconds, 60 * 60 * 60)
+        seconds = days * 86400 + rest
+    return seconds
+
+
+def parse_memory(value):
+    # '123456kb' -> bytes
+    if value is None:
+        return None
+    value = value.strip().lower()
+    digits = len(value) - len(value.lstrip("0123456789"))
+    if digits == 0 or value[digits:] not in MEMORY_UNITS:
+        return None
+    return int(value[:digits]) * MEMORY_UNITS[value[digits:]]
+
+
+def parse_time(value):
+    # epoch seconds (qstat -x) or 'Mon Jan  1 10:00:00 2024' (qstat -f)
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(time.mktime(time.strptime(value, "%a %b %d %H:%M:%S %Y")))
+    except ValueError:
+        return None
+
+
+def job_template(job):
+    # the elements of an array are named '<array name>_<index>'
+    return job.array.name if job.array is not None else job.name
+
+
+def percentile(values, q):
+    # nearest rank
+    values = sorted(values)
+    return values[max(0, int(math.ceil(q / 100.0 * len(values))) - 1)]
+
+
+class ResourceHistory:
+    # Resources used by the finished jobs of all the pipelines of the user
+    # (start and end times, walltime, CPU seconds and memory), by job name
+    # template and shared through a file like the StatusCache. Only the last
+    # 'keep' jobs of every template are kept. See Pipeline.autosize
+    def __init__(self, filename=None, keep=100):
+        self.filename = filename if filename is not None else ResourceHistory.default_filename()
+        self.keep = keep
+
+    @staticmethod
+    def default_filename():
+        return os.path.join(os.path.expanduser("~"), ".questpipe", "resource_history.json")
+
+    def load(self):
+        try:
+            with open(self.filename, "rt") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    def add(self, records):
+        # 'records' are (template, usage) pairs; a scheduler job is only
+        # added once, even if several processes see it finish
+        if len(records) == 0:
+            return
+        with file_lock(self.filename):
+            templates = self.load()
+            for template, usage in records:
+                usages = templates.setdefault(template, [])
+                if any(previous.get("job_id") == usage.get("job_id") for previous in usages):
+                    continue
+                usages.append(usage)
+                del usages[:-self.keep]
+            write_atomically(self.filename, json.dumps(templates))
+
+    @staticmethod
+    def estimate(usages, q=90, margin=1.2):
+        # {"walltime": seconds, "ppn": cores} from the 'q' percentile of the
+        # jobs, plus a 'margin' (None when there are no measurements)
+        estimate = {"walltime": None, "ppn": None}
+        walltimes = [usage["walltime"] for usage in usages if usage.get("walltime")]
+        if len(walltimes) > 0:
+            estimate["walltime"] = int(math.ceil(percentile(walltimes, q) * margin / 60)) * 60
+        cores = [usage["cpu"] / usage["walltime"] for usage in usages if usage.get("walltime") and usage.get("cpu") is not None]
+        if len(cores) > 0:
+            estimate["ppn"] = max(1, int(math.ceil(percentile(cores, q) * margin)))
+        return estimate
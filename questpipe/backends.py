@@ -0,0 +1,482 @@
+import asyncio
+import itertools
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+from .accounting import parse_duration, parse_memory, parse_time
+from .monitor import PipelineMonitor
+
+
+class SchedulerError(Exception):
+    # 'transient' errors (the scheduler is busy or unreachable) are retried;
+    # the rest (e.g. invalid arguments) fail the same way on every attempt
+    def __init__(self, message, transient=True):
+        super().__init__(message)
+        self.transient = transient
+
+
+class JobSubmission:
+    # Everything a backend needs to submit a job. All the values are already
+    # rendered: 'msub_arguments' are the scheduler specific arguments of the
+    # user, and 'array_size' is not None for job arrays
+    def __init__(self, name, script, msub_arguments, dependences, notokdependences, workdir, outdir, errdir, hold, array_size=None):
+        self.name = name
+        self.script = script
+        self.msub_arguments = msub_arguments
+        self.dependences = dependences
+        self.notokdependences = notokdependences
+        self.workdir = workdir
+        self.outdir = outdir
+        self.errdir = errdir
+        self.hold = hold
+        self.array_size = array_size
+
+    def __repr__(self):
+        return "{} {} (afterok: {}, afternotok: {})".format(self.name, self.msub_arguments, self.dependences, self.notokdependences)
+
+
+class SchedulerBackend:
+    # seconds between status polls that make sense for this scheduler
+    min_poll_interval = 10
+
+    def __init__(self):
+        self.pipeline = None
+
+    def attach(self, pipeline):
+        self.pipeline = pipeline
+
+    def submit(self, submission):
+        # returns (job_name, job_id); raises SchedulerError
+        raise NotImplementedError()
+
+    async def submit_async(self, submission):
+        # asyncio version of 'submit'; by default it runs on a thread
+        return await asyncio.get_running_loop().run_in_executor(None, self.submit, submission)
+
+    def unhold(self, job_id):
+        raise NotImplementedError()
+
+    def cancel(self, job_id):
+        raise NotImplementedError()
+
+    def query_states(self, job_ids):
+        # returns {job_id: (PipelineMonitor state, exit code)}; the jobs that
+        # are not returned are done
+        raise NotImplementedError()
+
+    def query_usage(self, job_ids):
+        # returns {job_id: usage} of the finished jobs, with the keys "started",
+        # "finished" (epoch seconds), "walltime", "cpu" (seconds) and "memory"
+        # (bytes) that the scheduler reports
+        return {}
+
+
+class MoabBackend(SchedulerBackend):
+    QUEUE_STATES = "HQTWS"
+    RUNNING_STATES = "RE"
+    # messages of the errors that do not go away by retrying
+    PERMANENT_ERRORS = ["invalid", "illegal", "usage", "unknown option", "cannot parse", "no such file", "not allowed"]
+
+    def __init__(self, batch_size=1000, xml=True):
+        super().__init__()
+        self.batch_size = batch_size
+        # 'qstat -x' (XML) is used until it fails, then 'qstat -f'
+        self.xml = xml
+        # the last resources used reported for every job (see query_usage)
+        self.usage = {}
+
+    def submit(self, submission):
+        _, stdout, stderr, returncode = self.pipeline.exec_command_status("msub", self.__msub_arguments(submission), input=submission.script)
+        return self.__submitted(stdout, stderr, returncode)
+
+    async def submit_async(self, submission):
+        _, stdout, stderr, returncode = await self.pipeline.exec_command_async("msub", self.__msub_arguments(submission), input=submission.script)
+        return self.__submitted(stdout, stderr, returncode)
+
+    def __msub_arguments(self, submission):
+        msub_arguments = list(submission.msub_arguments)
+        if submission.array_size is not None:
+            msub_arguments.append("-t \"{}[0-{}]\"".format(submission.name, submission.array_size - 1))
+        if len(submission.dependences) > 0:
+            msub_arguments.append("-l depend=afterok:{}".format(":".join(submission.dependences)))
+        if len(submission.notokdependences) > 0:
+            msub_arguments.append("-l depend=afternotok:{}".format(":".join(submission.notokdependences)))
+
+        msub_arguments.append("-d \"{}\"".format(submission.workdir))
+        msub_arguments.append("-e \"{}\"".format(submission.errdir))
+        msub_arguments.append("-o \"{}\"".format(submission.outdir))
+
+        if submission.hold:
+            msub_arguments.append("-h")
+        return msub_arguments
+
+    def __submitted(self, stdout, stderr, returncode):
+        self.__check("msub", stderr, returncode)
+        moab_job_name = stdout.decode('utf8').strip()
+        if len(moab_job_name) == 0:
+            raise SchedulerError("msub returned no job id")
+        return moab_job_name, moab_job_name.split(".")[0]
+
+    def __check(self, command, stderr, returncode):
+        # the exit code tells if the command failed: stderr can have warnings
+        if returncode == 0:
+            if len(stderr) > 0:
+                self.pipeline.log("W: {} says: {}".format(command, stderr))
+            return
+        message = stderr.decode("utf8", "replace").strip()
+        transient = not any(error in message.lower() for error in MoabBackend.PERMANENT_ERRORS)
+        raise SchedulerError("{} exit code {}: {}".format(command, returncode, message), transient)
+
+    def unhold(self, job_id):
+        _, stdout, stderr, returncode = self.pipeline.exec_command_status("mjobctl", ["-u", "all", job_id])
+        self.__check("mjobctl", stderr, returncode)
+
+    def cancel(self, job_id):
+        _, stdout, stderr, returncode = self.pipeline.exec_command_status("mjobctl", ["-c", job_id])
+        self.__check("mjobctl", stderr, returncode)
+        if len(stdout) > 0:
+            self.pipeline.log("I: abort says: {}".format(stdout))
+
+    def query_states(self, job_ids):
+        # One 'qstat' for (at most) 'batch_size' jobs. The output is parsed
+        # while it is read and only the jobs of 'job_ids' are kept
+        states = {}
+        wanted = set(job_ids)
+        for i in range(0, len(job_ids), self.batch_size):
+            batch = job_ids[i:i + self.batch_size]
+            if self.xml:
+                try:
+                    self.__query_xml(batch, wanted, states)
+                    continue
+                except (ET.ParseError, SchedulerError) as e:
+                    self.pipeline.log("E: cannot parse 'qstat -x', using 'qstat -f': {}".format(e))
+                    self.xml = False
+            self.__query_full(batch, wanted, states)
+        return states
+
+    def __flags(self, flag):
+        # array elements are only listed one by one with '-t'
+        return [flag, "-t"] if len(self.pipeline.job_arrays) > 0 else [flag]
+
+    def __query_xml(self, job_ids, wanted, states):
+        parser = ET.XMLPullParser(events=["end"])
+        lines = 0
+        stream = self.pipeline.stream_command("qstat", self.__flags("-x") + job_ids)
+        for line in stream:
+            lines += 1
+            parser.feed(line)
+            for _, element in parser.read_events():
+                if element.tag != "Job":
+                    continue
+                job_id = (element.findtext("Job_Id") or "").split(".")[0]
+                if job_id in wanted:
+                    fields = {}
+                    for child in element:
+                        if len(child) > 0:
+                            # <resources_used><cput>... -> 'resources_used.cput'
+                            for grandchild in child:
+                                fields["{}.{}".format(child.tag, grandchild.tag)] = grandchild.text
+                        else:
+                            fields[child.tag] = child.text
+                    self.__add_job(job_id, fields, states)
+                element.clear()
+        if lines > 0:
+            parser.close()
+        elif stream.returncode != 0 and not MoabBackend.only_unknown_jobs(stream.stderr):
+            # nothing on stdout: '-x' is not supported by this qstat
+            raise SchedulerError("qstat exit code {}: {}".format(stream.returncode, stream.stderr))
+
+    @staticmethod
+    def only_unknown_jobs(stderr):
+        # qstat fails when some job has been purged, but lists the rest
+        lines = [line for line in stderr.decode("utf8", "replace").splitlines() if len(line.strip()) > 0]
+        return all("Unknown Job" in line for line in lines)
+
+    def __query_full(self, job_ids, wanted, states):
+        # the jobs are added when the whole output is read: a 'qstat' that
+        # fails does not make the jobs look finished
+        job_id = None
+        fields = {}
+        found = {}
+        stream = self.pipeline.stream_command("qstat", self.__flags("-f") + job_ids)
+        for line in itertools.chain(stream, [b"Job Id: "]):
+            line = line.decode("utf8")
+            if line.startswith("Job Id:"):
+                if job_id in wanted:
+                    found[job_id] = fields
+                job_id = line[len("Job Id:"):].strip().split(".")[0] or None
+                fields = {}
+                continue
+            index = line.find(" = ")
+            if index != -1:
+                fields[line[:index].strip()] = line[index + 3:].strip()
+        if stream.returncode != 0 and not MoabBackend.only_unknown_jobs(stream.stderr):
+            raise SchedulerError("qstat exit code {}: {}".format(stream.returncode, stream.stderr))
+        for job_id, fields in found.items():
+            self.__add_job(job_id, fields, states)
+
+    def __add_job(self, job_id, fields, states):
+        states[job_id] = MoabBackend.job_state(fields.get("job_state", "C"), fields.get("exit_status"))
+        usage = MoabBackend.job_usage(fields)
+        if usage is not None:
+            self.usage[job_id] = usage
+
+    def query_usage(self, job_ids):
+        # The resources are read from the same 'qstat' output of the states:
+        # the last values seen for a job (if the scheduler purged it before it
+        # was seen completed, the last values seen while running). The jobs
+        # not seen by this process (e.g. with a status cache) are asked once
+        missing = [job_id for job_id in job_ids if job_id not in self.usage]
+        if len(missing) > 0:
+            try:
+                self.query_states(missing)
+            except SchedulerError as e:
+                self.pipeline.log("E: cannot ask the resources used by {}: {}".format(missing, e))
+        return {job_id: self.usage.pop(job_id) for job_id in job_ids if job_id in self.usage}
+
+    @staticmethod
+    def job_usage(fields):
+        started = parse_time(fields.get("start_time"))
+        if started is None:
+            return None
+        walltime = parse_duration(fields.get("resources_used.walltime"))
+        finished = parse_time(fields.get("comp_time"))
+        if finished is None and walltime is not None:
+            finished = started + walltime
+        if walltime is None and finished is not None:
+            walltime = finished - started
+        return {
+            "started": started,
+            "finished": finished,
+            "walltime": walltime,
+            "cpu": parse_duration(fields.get("resources_used.cput")),
+            "memory": parse_memory(fields.get("resources_used.mem"))}
+
+    @staticmethod
+    def job_state(state, exit_code):
+        exit_code = int(exit_code) if exit_code is not None and exit_code.lstrip("-").isdigit() else None
+        if state in MoabBackend.QUEUE_STATES:
+            return PipelineMonitor.QUEUED, None
+        if state in MoabBackend.RUNNING_STATES:
+            return PipelineMonitor.RUNNING, None
+        if exit_code is not None and exit_code != 0:
+            return PipelineMonitor.FAILED, exit_code
+        return PipelineMonitor.COMPLETED, exit_code
+
+
+class LocalJob:
+    HELD = "held"
+    WAITING = "waiting"
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    FINISHED_STATES = [COMPLETED, FAILED, CANCELLED]
+
+    def __init__(self, job_id, submission, array_index=None):
+        self.job_id = job_id
+        self.submission = submission
+        self.array_index = array_index
+        self.elements = []
+        self.state = LocalJob.HELD if submission.hold else LocalJob.WAITING
+        self.exit_code = None
+        self.process = None
+        self.usage = None
+
+
+class LocalBackend(SchedulerBackend):
+    # Runs the jobs on this machine, 'max_workers' at the same time (all the
+    # cores by default). Dependences, hold and cancel follow the MOAB rules: a
+    # job whose dependences cannot be satisfied anymore is cancelled.
+    min_poll_interval = 0.5
+
+    def __init__(self, max_workers=None):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers if max_workers is not None else os.cpu_count())
+        self.lock = threading.RLock()
+        self.jobs = {}
+        self.next_id = 1
+
+    def submit(self, submission):
+        with self.lock:
+            job_id = str(self.next_id)
+            self.next_id += 1
+            for dependence in submission.dependences + submission.notokdependences:
+                if dependence not in self.jobs:
+                    raise SchedulerError("Unknown dependence {}".format(dependence), transient=False)
+            job = LocalJob(job_id, submission)
+            self.jobs[job_id] = job
+            if submission.array_size is not None:
+                for index in range(submission.array_size):
+                    element = LocalJob("{}[{}]".format(job_id, index), submission, index)
+                    job.elements.append(element)
+                    self.jobs[element.job_id] = element
+            self.__schedule()
+        return "{}.local".format(job_id), job_id
+
+    def unhold(self, job_id):
+        with self.lock:
+            job = self.__job(job_id)
+            for current in [job] + job.elements:
+                if current.state == LocalJob.HELD:
+                    current.state = LocalJob.WAITING
+            self.__schedule()
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.__job(job_id)
+            for current in [job] + job.elements:
+                if current.state not in LocalJob.FINISHED_STATES:
+                    if current.process is not None:
+                        # the whole process group: the children of the
+                        # script do not keep running (see process.kill_process)
+                        try:
+                            os.killpg(current.process.pid, signal.SIGKILL)
+                        except ProcessLookupError:
+                            pass
+                    current.state = LocalJob.CANCELLED
+            self.__schedule()
+
+    def query_states(self, job_ids):
+        states = {}
+        with self.lock:
+            for job_id in job_ids:
+                if job_id not in self.jobs:
+                    continue
+                state = self.__state(self.jobs[job_id])
+                if state in [LocalJob.HELD, LocalJob.WAITING, LocalJob.QUEUED]:
+                    states[job_id] = (PipelineMonitor.QUEUED, None)
+                elif state == LocalJob.RUNNING:
+                    states[job_id] = (PipelineMonitor.RUNNING, None)
+                elif state == LocalJob.COMPLETED:
+                    states[job_id] = (PipelineMonitor.COMPLETED, 0)
+                else:
+                    states[job_id] = (PipelineMonitor.FAILED, self.__exit_code(self.jobs[job_id]))
+        return states
+
+    def query_usage(self, job_ids):
+        with self.lock:
+            return {job_id: self.jobs[job_id].usage for job_id in job_ids if job_id in self.jobs and self.jobs[job_id].usage is not None}
+
+    def wait(self):
+        self.executor.shutdown(wait=True)
+
+    def __job(self, job_id):
+        if job_id not in self.jobs:
+            raise SchedulerError("Unknown job {}".format(job_id), transient=False)
+        return self.jobs[job_id]
+
+    def __state(self, job):
+        if len(job.elements) == 0:
+            return job.state
+        states = [element.state for element in job.elements]
+        for state in [LocalJob.RUNNING, LocalJob.QUEUED, LocalJob.WAITING, LocalJob.HELD, LocalJob.CANCELLED, LocalJob.FAILED]:
+            if state in states:
+                return state
+        return LocalJob.COMPLETED
+
+    def __exit_code(self, job):
+        if len(job.elements) == 0:
+            return job.exit_code
+        for element in job.elements:
+            if element.exit_code is not None and element.exit_code != 0:
+                return element.exit_code
+        return None
+
+    def __dependences_state(self, submission):
+        # True: satisfied, False: cannot be satisfied, None: still waiting
+        result = True
+        for dependence in submission.dependences:
+            state = self.__state(self.jobs[dependence])
+            if state in [LocalJob.FAILED, LocalJob.CANCELLED]:
+                return False
+            if state != LocalJob.COMPLETED:
+                result = None
+        for dependence in submission.notokdependences:
+            state = self.__state(self.jobs[dependence])
+            if state in [LocalJob.COMPLETED, LocalJob.CANCELLED]:
+                return False
+            if state != LocalJob.FAILED:
+                result = None
+        return result
+
+    def __schedule(self):
+        changed = True
+        while changed:
+            changed = False
+            for job in self.jobs.values():
+                if job.state != LocalJob.WAITING or len(job.elements) > 0:
+                    continue
+                dependences_state = self.__dependences_state(job.submission)
+                if dependences_state is None:
+                    continue
+                if dependences_state:
+                    job.state = LocalJob.QUEUED
+                    self.executor.submit(self.__run, job)
+                else:
+                    job.state = LocalJob.CANCELLED
+                    changed = True
+
+    def __run(self, job):
+        with self.lock:
+            if job.state != LocalJob.QUEUED:
+                return
+            job.state = LocalJob.RUNNING
+            submission = job.submission
+            env = os.environ.copy()
+            env["PBS_JOBID"] = env["MOAB_JOBID"] = job.job_id
+            env["PBS_JOBNAME"] = env["MOAB_JOBNAME"] = submission.name
+            suffix = job.job_id
+            if job.array_index is not None:
+                env["PBS_ARRAYID"] = env["MOAB_JOBARRAYINDEX"] = str(job.array_index)
+                suffix = "{}-{}".format(job.job_id.split("[")[0], job.array_index)
+            script_filename = None
+            try:
+                stdout = open(os.path.join(submission.outdir, "{}.o{}".format(submission.name, suffix)), "wb")
+                stderr = open(os.path.join(submission.errdir, "{}.e{}".format(submission.name, suffix)), "wb")
+                # the script is a file, like on MOAB: the commands that read
+                # stdin get nothing instead of the rest of the script
+                fd, script_filename = tempfile.mkstemp(prefix="questpipe.", suffix=".sh")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(bytes(submission.script, "utf-8"))
+                job.process = subprocess.Popen(["/bin/bash", script_filename], stdin=subprocess.DEVNULL, stdout=stdout, stderr=stderr, cwd=submission.workdir, env=env, start_new_session=True)
+            except OSError as e:
+                if script_filename is not None:
+                    os.remove(script_filename)
+                self.pipeline.log("E: cannot start local job {}: {}".format(job.job_id, e))
+                job.state = LocalJob.FAILED
+                job.exit_code = -1
+                self.__schedule()
+                return
+
+        started = time.time()
+        try:
+            # wait4 also returns the resources used by the job
+            _, status, rusage = os.wait4(job.process.pid, 0)
+            job.process.returncode = os.waitstatus_to_exitcode(status)
+            cpu = rusage.ru_utime + rusage.ru_stime
+            memory = rusage.ru_maxrss * 1024
+        except ChildProcessError:
+            # already collected by a 'cancel'
+            job.process.wait()
+            cpu = memory = None
+        finished = time.time()
+        stdout.close()
+        stderr.close()
+        os.remove(script_filename)
+
+        with self.lock:
+            job.usage = {"started": started, "finished": finished, "walltime": finished - started, "cpu": cpu, "memory": memory}
+            job.exit_code = job.process.returncode
+            job.process = None
+            if job.state != LocalJob.CANCELLED:
+                job.state = LocalJob.COMPLETED if job.exit_code == 0 else LocalJob.FAILED
+            self.__schedule()
@@ -0,0 +1,210 @@
+def job_parents(job):
+    # elements of a job array are submitted with their array
+    parents = []
+    if job.dependences is not None:
+        parents.extend(job.dependences)
+    if job.notokdependences is not None:
+        parents.extend(job.notokdependences)
+    return [parent.array if parent.array is not None else parent for parent in parents]
+
+
+def dependence_levels(jobs):
+    # Kahn's algorithm restricted to 'jobs': parents outside the set are
+    # considered already submitted and do not delay any level
+    pending = {id(job): job for job in jobs}
+    indegree = {key: 0 for key in pending}
+    children = {key: [] for key in pending}
+    for job in jobs:
+        for parent in job_parents(job):
+            if id(parent) in pending:
+                indegree[id(job)] += 1
+                children[id(parent)].append(job)
+
+    levels = []
+    current = [job for job in jobs if indegree[id(job)] == 0]
+    visited = 0
+    while len(current) > 0:
+        levels.append(current)
+        visited += len(current)
+        following = []
+        for job in current:
+            for child in children[id(job)]:
+                indegree[id(child)] -= 1
+                if indegree[id(child)] == 0:
+                    following.append(child)
+        current = following
+
+    if visited != len(jobs):
+        cycle = [job.name for job in jobs if indegree[id(job)] > 0]
+        raise Exception("dependence cycle between jobs: {}".format(cycle))
+    return levels
+
+
+def covers(implied, parent):
+    # a job is ok when it, or its whole array, is an afterok ancestor; an
+    # element being an ancestor does not make its whole array ok
+    return id(parent) in implied or (parent.array is not None and id(parent.array) in implied)
+
+
+def reduced_dependences(job, ancestors):
+    # 'job.dependences' without the ones implied by the others: a dependence
+    # that is an afterok ancestor of another dependence (or an element of a
+    # whole array the job depends on) has to be ok anyway. afternotok paths
+    # do not imply anything, so they are not followed
+    implied = set()
+    for parent in job.dependences:
+        implied |= ancestors.get(parent)
+    groups = set(id(parent) for parent in job.dependences if parent.array is None)
+    result = []
+    seen = set()
+    for parent in job.dependences:
+        if id(parent) in seen or covers(implied, parent):
+            continue
+        if parent.array is not None and id(parent.array) in groups:
+            continue
+        seen.add(id(parent))
+        result.append(parent)
+
+    # every dependence removed must still be waited for through the rest
+    kept = set()
+    for parent in result:
+        kept.add(id(parent))
+        kept |= ancestors.get(parent)
+    missing = [parent.name for parent in job.dependences if not covers(kept, parent)]
+    if len(missing) > 0:
+        raise Exception("reducing the dependences of {} would drop {}".format(job.name, missing))
+    return result
+
+
+class AfterokAncestors:
+    # Ids of the jobs, elements and whole arrays that must succeed before a
+    # job runs, computed on demand: long chains do not build big sets unless
+    # needed. An element runs once the dependences of its array are ok, so
+    # it has the ancestors of its array (but not the array itself)
+    def __init__(self):
+        self.memo = {}
+
+    def get(self, job):
+        stack = [job]
+        while len(stack) > 0:
+            current = stack[-1]
+            if id(current) in self.memo:
+                stack.pop()
+                continue
+            if current.array is not None:
+                if id(current.array) not in self.memo:
+                    stack.append(current.array)
+                    continue
+                self.memo[id(current)] = self.memo[id(current.array)]
+                stack.pop()
+                continue
+            parents = list(current.dependences or [])
+            missing = [parent for parent in parents if id(parent) not in self.memo]
+            if len(missing) > 0:
+                stack.extend(missing)
+                continue
+            ancestors = set()
+            for parent in parents:
+                ancestors.add(id(parent))
+                ancestors |= self.memo[id(parent)]
+            self.memo[id(current)] = ancestors
+            stack.pop()
+        return self.memo[id(job)]
+
+
+class RuntimeHistory:
+    # Runtimes observed on previous runs, by rendered job name and by name
+    # template (e.g. every '02_tophat_{sample_name}')
+    def __init__(self):
+        self.names = {}
+        self.templates = {}
+
+    def add(self, name, template, seconds):
+        self.names[name] = seconds
+        self.templates.setdefault(template, []).append(seconds)
+
+    def add_pipeline(self, pipeline):
+        for job in pipeline.jobs:
+            runtime = job.observed_runtime
+            if runtime is not None and job.exit_code in [0, None]:
+                self.add(job.parse_string(job.name), job.name, runtime)
+
+    def knows(self, name, template):
+        return name in self.names or template in self.templates
+
+    def estimate(self, name, template, default_runtime):
+        if name in self.names:
+            return self.names[name]
+        if template in self.templates:
+            runtimes = sorted(self.templates[template])
+            return runtimes[len(runtimes) // 2]
+        return default_runtime
+
+
+class CriticalPath:
+    # Earliest and latest start of every job from its estimated runtime: the
+    # slack is how much a job can be delayed without delaying the pipeline,
+    # and the jobs without slack are the critical path
+    def __init__(self, jobs, runtimes):
+        self.jobs = jobs
+        self.runtimes = runtimes
+        self.earliest_start = {}
+        self.latest_start = {}
+        self.makespan = 0
+        self.path = []
+
+        levels = dependence_levels(jobs)
+        keys = set(id(job) for job in jobs)
+        children = {id(job): [] for job in jobs}
+        for level in levels:
+            for job in level:
+                parents = [parent for parent in job_parents(job) if id(parent) in keys]
+                for parent in parents:
+                    children[id(parent)].append(job)
+                self.earliest_start[id(job)] = max([self.earliest_finish(parent) for parent in parents] + [0])
+                self.makespan = max(self.makespan, self.earliest_finish(job))
+
+        for level in reversed(levels):
+            for job in level:
+                latest_finish = min([self.latest_start[id(child)] for child in children[id(job)]] + [self.makespan])
+                self.latest_start[id(job)] = latest_finish - runtimes[id(job)]
+
+        # from the last job back to the first one, through the jobs without slack
+        current = [job for job in jobs if close(self.earliest_finish(job), self.makespan) and self.is_critical(job)]
+        while len(current) > 0:
+            job = current[0]
+            self.path.insert(0, job)
+            current = [
+                parent for parent in job_parents(job)
+                if id(parent) in keys and self.is_critical(parent) and close(self.earliest_finish(parent), self.earliest_start[id(job)])]
+
+    def earliest_finish(self, job):
+        return self.earliest_start[id(job)] + self.runtimes[id(job)]
+
+    def slack(self, job):
+        return self.latest_start[id(job)] - self.earliest_start[id(job)]
+
+    def is_critical(self, job):
+        return close(self.slack(job), 0)
+
+    def __str__(self):
+        lines = ["Expected makespan: {}".format(format_seconds(self.makespan))]
+        lines.append("{:<40} {:>10} {:>10} {:>10}".format("job", "runtime", "start", "slack"))
+        path = set(id(job) for job in self.path)
+        for job in sorted(self.jobs, key=lambda job: (self.slack(job), self.earliest_start[id(job)])):
+            lines.append("{:<40} {:>10} {:>10} {:>10}{}".format(
+                job.parse_string(job.name)[:40],
+                format_seconds(self.runtimes[id(job)]),
+                format_seconds(self.earliest_start[id(job)]),
+                format_seconds(self.slack(job)),
+                " *" if id(job) in path else ""))
+        return "\n".join(lines)
+
+
+def close(a, b):
+    return abs(a - b) < 1e-6
+
+
+def format_seconds(seconds):
+    seconds = int(round(seconds))
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
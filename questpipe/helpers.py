@@ -1,12 +1,16 @@
-from . import Pipeline
-import time
+from . import Pipeline, PipelineMonitor
 
 
-def wait_for_pipeline(state_filename):
+def wait_for_pipeline(state_filename, min_interval=10, max_interval=300, status_cache=True):
+    # 'state_filename' can be the folder of 'pipeline.json' too
+    state_filename = Pipeline.state_filename(state_filename)
     pipeline = Pipeline.load_state(state_filename)
-    while True:
-        time.sleep(60)
-        queue_count, running_count, completed_count = pipeline.checkjobs()
-        if running_count == 0 and queue_count == 0:
-            pipeline.log("I: Completed!")
-            break
\ No newline at end of file
+    if status_cache:
+        pipeline.use_status_cache()
+    # the resources used by the jobs seen finishing are kept for Pipeline.autosize
+    pipeline.use_resource_history()
+    monitor = PipelineMonitor(pipeline, min_interval=min_interval, max_interval=max_interval)
+    monitor.wait()
+    pipeline.log("I: Completed!")
+    # the exit codes are needed to reuse the jobs on the next run
+    pipeline.save_state(state_filename, journal=False)
\ No newline at end of file
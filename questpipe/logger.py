@@ -0,0 +1,103 @@
+import atexit
+import json
+import os
+import queue
+import threading
+from datetime import datetime
+
+
+class PipelineLogger:
+    # Writes the messages of Pipeline.log on a background thread, so the
+    # submission does not wait for a slow (shared) filesystem. The messages
+    # start with their level ("D: ", "I: ", "W: ", "E: "); the ones below
+    # 'level' are dropped. They are written in batches of 'flush_records'
+    # messages or every 'flush_interval' seconds, as text or as JSON lines.
+    # With 'max_bytes', the file is rotated like logging.RotatingFileHandler
+    # ('pipeline.log' -> 'pipeline.log.1' -> ... 'pipeline.log.<backup_count>')
+    LEVELS = ["D", "I", "W", "E"]
+
+    def __init__(self, filename, level="I", json_lines=False, max_bytes=None, backup_count=3, flush_interval=1.0, flush_records=1000, name=None):
+        self.filename = filename
+        self.level = PipelineLogger.LEVELS.index(level)
+        self.json_lines = json_lines
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.flush_records = flush_records
+        self.name = name
+        self.queue = queue.SimpleQueue()
+        self.file = open(filename, "wt")
+        self.closed = False
+        self.thread = threading.Thread(target=self.__write_loop, name="questpipe-logger", daemon=True)
+        self.thread.start()
+        # the daemon thread dies with the interpreter: write what is left
+        atexit.register(self.close)
+
+    def log(self, message):
+        level = message[0] if len(message) > 1 and message[1] == ":" and message[0] in PipelineLogger.LEVELS else "I"
+        if PipelineLogger.LEVELS.index(level) < self.level or self.closed:
+            return
+        self.queue.put((datetime.now(), level, message))
+
+    def flush(self):
+        # returns when every message logged before is on the file
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        atexit.unregister(self.close)
+
+    def __write_loop(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.flush_records:
+                    batch.append(self.queue.get(timeout=self.flush_interval if len(batch) == 1 else 0))
+            except queue.Empty:
+                pass
+            events = []
+            lines = []
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    events.append(item)
+                else:
+                    lines.append(self.__format(*item))
+            if len(lines) > 0:
+                self.__write("".join(lines))
+            for event in events:
+                event.set()
+
+    def __format(self, timestamp, level, message):
+        if not self.json_lines:
+            return "{}\n".format(message)
+        if message.startswith("{}: ".format(level)):
+            message = message[3:]
+        record = {"time": timestamp.isoformat(), "level": level, "message": message}
+        if self.name is not None:
+            record["pipeline"] = self.name
+        return "{}\n".format(json.dumps(record))
+
+    def __write(self, text):
+        if self.max_bytes is not None and self.file.tell() + len(text) > self.max_bytes and self.file.tell() > 0:
+            self.__rotate()
+        self.file.write(text)
+        self.file.flush()
+
+    def __rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.filename, i)):
+                os.replace("{}.{}".format(self.filename, i), "{}.{}".format(self.filename, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.filename, "{}.1".format(self.filename))
+        self.file = open(self.filename, "wt")
@@ -0,0 +1,119 @@
+import json
+import math
+import threading
+import time
+
+from .state import write_atomically
+
+
+class Histogram:
+    # Latencies grouped in buckets of powers of 2 microseconds, so the memory
+    # does not grow with the number of samples
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        bucket = max(0, math.ceil(math.log2(max(seconds * 1e6, 1))))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, q):
+        # upper bound of the bucket of the percentile 'q' (0-100)
+        if self.count == 0:
+            return None
+        limit = q / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= limit:
+                return min(2 ** bucket / 1e6, self.max)
+        return self.max
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total / self.count if self.count > 0 else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": {"{:g}".format(2 ** bucket / 1e6): n for bucket, n in sorted(self.buckets.items())}}
+
+
+class Timer:
+    __slots__ = ["metrics", "name", "start"]
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add(self.name, time.perf_counter() - self.start)
+
+
+class Metrics:
+    # Timers and counters of the pipeline operations. The pipeline only has a
+    # Metrics object when they are enabled (see Pipeline.enable_metrics), so
+    # the instrumented code only checks 'pipeline.metrics is not None'
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+
+    @staticmethod
+    def default_filename(state_filename):
+        # stored next to the state, like the journal
+        return "{}.metrics".format(state_filename)
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def add(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_json(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "elapsed": time.time() - self.started,
+                "counters": dict(self.counters),
+                "latencies": {name: histogram.to_json() for name, histogram in self.histograms.items()}}
+
+    def save(self, filename):
+        write_atomically(filename, json.dumps(
+            self.to_json(),
+            sort_keys=True,
+            indent=4,
+            separators=(',', ': ')))
+
+    def summary(self):
+        data = self.to_json()
+        lines = ["{:<28} {:>8} {:>10} {:>10} {:>10} {:>10}".format("operation", "count", "total(s)", "mean(ms)", "p90(ms)", "max(ms)")]
+        for name, histogram in sorted(data["latencies"].items(), key=lambda item: -item[1]["total"]):
+            lines.append("{:<28} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                name, histogram["count"], histogram["total"], histogram["mean"] * 1000, histogram["p90"] * 1000, histogram["max"] * 1000))
+        for name, value in sorted(data["counters"].items()):
+            lines.append("{:<28} {:>8}".format(name, value))
+        return "\n".join(lines)
@@ -0,0 +1,184 @@
+import collections
+import time
+
+from .accounting import job_template
+
+
+JobStateChange = collections.namedtuple("JobStateChange", ["job", "old_state", "new_state", "exit_code"])
+
+
+class JobCounts(collections.namedtuple("JobCounts", ["queued", "running", "completed"])):
+    # unpacked like the (queued, running, completed) tuple of older versions;
+    # 'states' maps the id of every job to its state and 'unknown' counts the
+    # jobs without a state (the scheduler could not be asked)
+    def __new__(cls, queued, running, completed, states, unknown=0):
+        counts = super().__new__(cls, queued, running, completed)
+        counts.states = states
+        counts.unknown = unknown
+        return counts
+
+
+class PipelineMonitor:
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+    FINISHED_STATES = [COMPLETED, FAILED]
+
+    # Keeps the state of every submitted job of the pipeline using a single
+    # scheduler query for each poll. The interval between polls is reset to
+    # 'min_interval' when a job changes its state and multiplied by 'backoff'
+    # (up to 'max_interval') when nothing moves.
+    def __init__(self, pipeline, min_interval=10, max_interval=300, backoff=2.0):
+        self.pipeline = pipeline
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.states = {}
+        self.exit_codes = {}
+        self.callbacks = []
+        self.last_poll = None
+        # seconds since the scheduler was asked for the states of the last
+        # poll (they can be older than the poll with a status cache)
+        self.age = None
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def tracked_jobs(self):
+        return [job for job in self.pipeline.jobs if job.moab_job_id is not None]
+
+    def poll(self, force=False):
+        jobs = self.tracked_jobs()
+        job_ids = list(dict.fromkeys(job.scheduler_job_id for job in jobs))
+        scheduler_states = self.pipeline.query_states(job_ids, force)
+        self.last_poll = time.time()
+        if scheduler_states is None:
+            # the query failed: the jobs keep their previous states
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+            return []
+        status_cache = self.pipeline.status_cache
+        self.age = status_cache.age if status_cache is not None else 0
+
+        changes = []
+        finished = []
+        # the jobs seen finishing by this monitor, not finished before it started
+        seen_finishing = []
+        for job in jobs:
+            old_state = self.states.get(job.moab_job_id)
+            if job.scheduler_job_id in scheduler_states:
+                state, exit_code = scheduler_states[job.scheduler_job_id]
+            elif job.exit_code is not None and job.exit_code != 0:
+                state, exit_code = PipelineMonitor.FAILED, job.exit_code
+            else:
+                # a job not listed by the scheduler is done
+                state, exit_code = PipelineMonitor.COMPLETED, job.exit_code
+            if job.array is not None:
+                state, exit_code = job.array.element_state(job, state, exit_code)
+            self.states[job.moab_job_id] = state
+            self.exit_codes[job.moab_job_id] = exit_code
+            if state in PipelineMonitor.FINISHED_STATES:
+                job.set_status(job.COMPLETED)
+                job.exit_code = exit_code
+            if state != old_state:
+                changes.append(JobStateChange(job, old_state, state, exit_code))
+                # the times are only known when the change is seen by this monitor
+                if old_state is not None and state == PipelineMonitor.RUNNING and job.started is None:
+                    job.started = self.last_poll
+                    self.pipeline.record("started", job, started=job.started)
+                if old_state is not None and state in PipelineMonitor.FINISHED_STATES and job.finished is None:
+                    job.finished = self.last_poll
+                if state in PipelineMonitor.FINISHED_STATES:
+                    finished.append(job)
+                    if old_state is not None:
+                        seen_finishing.append(job)
+        self.__completed(finished, seen_finishing)
+        for job_array in self.pipeline.job_arrays:
+            job_array.update_status()
+
+        for change in changes:
+            self.pipeline.log("I: {} ({}): {} -> {}".format(change.job.name, change.job.moab_job_id, change.old_state, change.new_state))
+            for callback in self.callbacks:
+                callback(change)
+
+        if len(changes) > 0:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        return changes
+
+    def __completed(self, jobs, seen_finishing):
+        # The resources used are asked once, when the job is seen finishing
+        # (the tasks of a packed job share them, so they are not asked). The
+        # jobs already finished when the monitor started are not asked: a
+        # new process (e.g. qp_checkjobs) would ask the scheduler for all of
+        # them every time, bypassing the status cache. The times of the
+        # scheduler replace the ones seen by the polls
+        pending = [job for job in seen_finishing if job.usage is None and job.scheduler_job_id == job.moab_job_id]
+        usages = self.pipeline.backend.query_usage([job.moab_job_id for job in pending]) if len(pending) > 0 else {}
+        history = []
+        for job in jobs:
+            usage = usages.get(job.moab_job_id)
+            if usage is not None:
+                job.usage = usage
+                if usage.get("started") is not None:
+                    job.started = usage["started"]
+                if usage.get("finished") is not None:
+                    job.finished = usage["finished"]
+                if job.exit_code in [0, None]:
+                    history.append((job_template(job), dict(usage, job_id=job.moab_job_id, pipeline=self.pipeline.name)))
+                self.pipeline.record("completed", job, status=job.status, exit_code=job.exit_code, started=job.started, finished=job.finished, usage=usage)
+            else:
+                self.pipeline.record("completed", job, status=job.status, exit_code=job.exit_code, finished=job.finished)
+        if self.pipeline.resource_history is not None:
+            self.pipeline.resource_history.add(history)
+
+    def refresh(self, max_age=None):
+        if self.last_poll is None or max_age is None or time.time() - self.last_poll > max_age:
+            self.poll()
+
+    def state(self, job, max_age=None):
+        if job.moab_job_id is None:
+            return None
+        if job.moab_job_id not in self.states:
+            self.refresh()
+        else:
+            self.refresh(max_age if max_age is not None else self.min_interval)
+        return self.states.get(job.moab_job_id)
+
+    @property
+    def is_finished(self):
+        return all(self.states.get(job.moab_job_id) in PipelineMonitor.FINISHED_STATES for job in self.tracked_jobs())
+
+    def counts(self):
+        queue_count = 0
+        running_count = 0
+        completed_count = 0
+        unknown_count = 0
+        states = {}
+        for job in self.tracked_jobs():
+            state = self.states.get(job.moab_job_id)
+            states[job.moab_job_id] = state
+            if state == PipelineMonitor.QUEUED:
+                queue_count += 1
+            elif state == PipelineMonitor.RUNNING:
+                running_count += 1
+            elif state is None:
+                unknown_count += 1
+            else:
+                completed_count += 1
+        return JobCounts(queue_count, running_count, completed_count, states, unknown_count)
+
+    def events(self):
+        while True:
+            for change in self.poll():
+                yield change
+            if self.is_finished:
+                return
+            time.sleep(self.interval)
+
+    def wait(self):
+        for _ in self.events():
+            pass
@@ -0,0 +1,145 @@
+import collections
+import os
+import signal
+import subprocess
+import threading
+
+
+def kill_process(p, grace=5):
+    # the commands run on a shell: the whole process group is killed, so the
+    # children of the shell do not keep running (and keep the pipes open).
+    # 'p' must be started with start_new_session=True
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+        try:
+            p.wait(timeout=grace)
+        except subprocess.TimeoutExpired:
+            os.killpg(p.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class CommandError(Exception):
+    # The local steps that failed, raised together (see Pipeline.run_many).
+    # 'failures' has (command, exit code, stderr) of every failed step; the
+    # steps that were not run because a previous step failed have None
+    def __init__(self, failures):
+        self.failures = failures
+        lines = ["{} local steps failed".format(len(failures))]
+        for command, returncode, stderr in failures:
+            lines.append("  {} (exit code {}): {}".format(" ".join(command.split()), returncode, stderr.strip()))
+        super().__init__("\n".join(lines))
+
+
+def run_command(command, timeout=None):
+    # a module function, so it can run on a process pool too
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, start_new_session=timeout is not None)
+    try:
+        stdout, stderr = p.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process(p)
+        stdout, stderr = p.communicate()
+        stderr += bytes("questpipe: killed after {} seconds\n".format(timeout), "utf-8")
+    return None, stdout, stderr, p.returncode
+
+
+class CommandStream:
+    # The output of a command read while it runs: iterating it yields the
+    # lines of stdout (bytes); 'returncode' and 'stderr' are set when stdout
+    # ends. Only the last 'tail_lines' lines of stdout and stderr are kept
+    # ('stdout_tail', 'stderr'), so a chatty command does not fill the memory.
+    # 'on_line' and 'on_stderr_line' receive every line while the command
+    # runs. After 'timeout' seconds the command is killed and 'timed_out' is
+    # set.
+    def __init__(self, command, on_finished=None, input=None, timeout=None, tail_lines=100, on_line=None, on_stderr_line=None):
+        self.command = command
+        self.on_finished = on_finished
+        self.input = input
+        self.timeout = timeout
+        self.on_line = on_line
+        self.on_stderr_line = on_stderr_line
+        self.returncode = None
+        self.stderr = None
+        self.timed_out = False
+        self.lines = None
+        self.__stdout_tail = collections.deque(maxlen=tail_lines)
+        self.__stderr_tail = collections.deque(maxlen=tail_lines)
+
+    @staticmethod
+    def from_output(stdout, stderr, returncode):
+        # for the commands already executed (e.g. on a session)
+        stream = CommandStream(None)
+        stream.lines = stdout.splitlines(True)
+        stream.stderr = stderr
+        stream.returncode = returncode
+        return stream
+
+    @property
+    def stdout_tail(self):
+        return b"".join(self.__stdout_tail)
+
+    def wait(self):
+        # reads the whole output (only the callbacks and the tails see it)
+        for _ in self:
+            pass
+        return self.returncode
+
+    def __iter__(self):
+        if self.lines is not None:
+            for line in self.lines:
+                self.__stdout_tail.append(line)
+                if self.on_line is not None:
+                    self.on_line(line)
+                yield line
+            return
+        p = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE if self.input is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, start_new_session=self.timeout is not None)
+        threads = [threading.Thread(target=self.__read_stderr, args=(p.stderr,), daemon=True)]
+        if self.input is not None:
+            threads.append(threading.Thread(target=self.__write_input, args=(p.stdin,), daemon=True))
+        for thread in threads:
+            thread.start()
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, self.__kill, args=(p,))
+            timer.daemon = True
+            timer.start()
+        try:
+            for line in p.stdout:
+                self.__stdout_tail.append(line)
+                if self.on_line is not None:
+                    self.on_line(line)
+                yield line
+        finally:
+            if timer is not None:
+                timer.cancel()
+            p.stdout.close()
+            p.wait()
+            for thread in threads:
+                thread.join()
+        if self.timed_out:
+            self.__stderr_tail.append(bytes("questpipe: killed after {} seconds\n".format(self.timeout), "utf-8"))
+        self.stderr = b"".join(self.__stderr_tail)
+        self.returncode = p.returncode
+        if self.on_finished is not None:
+            self.on_finished(self)
+
+    def __read_stderr(self, stderr):
+        for line in stderr:
+            self.__stderr_tail.append(line)
+            if self.on_stderr_line is not None:
+                self.on_stderr_line(line)
+        stderr.close()
+
+    def __write_input(self, stdin):
+        try:
+            stdin.write(bytes(self.input, "utf-8"))
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def __kill(self, p):
+        self.timed_out = True
+        kill_process(p)
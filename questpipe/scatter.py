@@ -0,0 +1,49 @@
+import math
+import os
+
+
+def chunk_count(filename, chunk_bytes, max_chunks):
+    # one chunk for every 'chunk_bytes' of the input, at least 1
+    return max(1, min(max_chunks, int(math.ceil(os.path.getsize(filename) / float(chunk_bytes)))))
+
+
+def split_records_command(chunks, record_lines=4, compress=True):
+    # Template of the command of the split job: deals the records of
+    # {scatter_input} ('record_lines' lines each: 4 on a FASTQ) round-robin
+    # to the files {chunk_prefix}<index>{chunk_suffix}, so the chunks have
+    # the same number of records (+-1) without counting them first. The
+    # braces of the shell and awk code are escaped for the templates
+    if compress:
+        empty = 'gzip -c < /dev/null > "{chunk_prefix}$__qp_i{chunk_suffix}"'
+        output = 'print | ("gzip -c > \\"" file "\\"")'
+    else:
+        empty = ': > "{chunk_prefix}$__qp_i{chunk_suffix}"'
+        output = "print > file"
+    lines = [
+        # the chunks exist even when there are less records than chunks
+        "for __qp_i in $(seq 0 {}); do {} || exit 1; done".format(chunks - 1, empty),
+        'case "{scatter_input}" in *.gz) __qp_cat="gzip -dc" ;; *) __qp_cat=cat ;; esac',
+        '$__qp_cat "{{scatter_input}}" | awk -v n={} -v lines={} -v prefix="{{chunk_prefix}}" -v suffix="{{chunk_suffix}}" \''.format(chunks, record_lines)
+        + "{{{{ file = prefix (int((NR - 1) / lines) % n) suffix; {} }}}}'".format(output),
+        # the exit code of the reader, not only the one of awk
+        'exit $(( ${{PIPESTATUS[0]}} | ${{PIPESTATUS[1]}} ))']
+    return "\n".join(lines)
+
+
+class ScatterGather:
+    # The jobs of Pipeline.scatter_gather: 'split' writes the chunks, every
+    # job of 'chunks' processes one of them and 'gather' merges their outputs
+    def __init__(self, split, chunks, gather):
+        self.split = split
+        self.chunks = chunks
+        self.gather = gather
+
+    @property
+    def jobs(self):
+        return [self.split] + self.chunks + [self.gather]
+
+    def launch(self, NUMBER_OF_ATTEMPTS=3):
+        # submits the jobs one by one (or use Pipeline.submit_all)
+        for job in self.jobs:
+            job.launch(NUMBER_OF_ATTEMPTS=NUMBER_OF_ATTEMPTS)
+        return self.gather
@@ -0,0 +1,114 @@
+import os
+import re
+import selectors
+import signal
+import subprocess
+import time
+import uuid
+
+
+class SessionError(Exception):
+    pass
+
+
+class CommandSession:
+    # A long-lived shell that runs commands one after another, so every
+    # command does not pay the fork and exec of a new shell. The output of
+    # each command is delimited with a random marker followed by its exit
+    # code. The shell is started again on the next command when it dies or
+    # when a command times out.
+    def __init__(self, shell="/bin/bash", timeout=None):
+        self.shell = shell
+        self.timeout = timeout
+        self.process = None
+        self.marker = None
+
+    def start(self):
+        self.marker = "__questpipe_{}__".format(uuid.uuid4().hex)
+        self.process = subprocess.Popen(
+            [self.shell],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=True)
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+        self.process = None
+
+    def kill(self):
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.wait()
+        self.process = None
+
+    @property
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def run(self, command, input=None, timeout=None):
+        # returns (stdout, stderr, exit code), like a subprocess
+        if not self.is_alive:
+            self.kill()
+            self.start()
+        if timeout is None:
+            timeout = self.timeout
+
+        if input is not None:
+            # the input follows the line of 'head' on the stdin of the shell:
+            # 'head' copies exactly its bytes to a file before the command
+            # runs, so the command reads it unchanged and the shell never does
+            data = bytes(input, "utf-8")
+            script = bytes('__qp_in=$(mktemp); head -c {} > "${{__qp_in:-/dev/null}}"\n'.format(len(data)), "utf-8") + data
+            script += bytes('{{ {}\n}} < "${{__qp_in:-/dev/null}}"\n__qp_rc=$?; rm -f "$__qp_in"\n'.format(command), "utf-8")
+        else:
+            script = bytes("{{ {}\n}} < /dev/null\n__qp_rc=$?\n".format(command), "utf-8")
+        script += bytes("printf '\\n{0} %d\\n' $__qp_rc\nprintf '\\n{0}\\n' >&2\n".format(self.marker), "utf-8")
+
+        try:
+            self.process.stdin.write(script)
+            self.process.stdin.flush()
+            return self.__read(timeout)
+        except (OSError, SessionError):
+            self.kill()
+            raise
+
+    def __read(self, timeout):
+        marker = bytes(self.marker, "utf-8")
+        stdout_end = re.compile(b"\n" + marker + b" (-?\\d+)\n$")
+        stderr_end = b"\n" + marker + b"\n"
+        buffers = {self.process.stdout: bytearray(), self.process.stderr: bytearray()}
+        done = {self.process.stdout: False, self.process.stderr: False}
+
+        deadline = time.time() + timeout if timeout is not None else None
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.process.stdout, selectors.EVENT_READ)
+            selector.register(self.process.stderr, selectors.EVENT_READ)
+            while not all(done.values()):
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise SessionError("timeout after {} seconds".format(timeout))
+                for key, _ in selector.select(remaining):
+                    data = os.read(key.fileobj.fileno(), 65536)
+                    if len(data) == 0:
+                        raise SessionError("the session finished unexpectedly")
+                    buffers[key.fileobj] += data
+                    if key.fileobj is self.process.stdout:
+                        done[key.fileobj] = stdout_end.search(buffers[key.fileobj][-256:]) is not None
+                    else:
+                        done[key.fileobj] = buffers[key.fileobj].endswith(stderr_end)
+                    if done[key.fileobj]:
+                        selector.unregister(key.fileobj)
+
+        stdout = bytes(buffers[self.process.stdout])
+        match = stdout_end.search(stdout)
+        stderr = bytes(buffers[self.process.stderr])
+        return stdout[:match.start()], stderr[:-len(stderr_end)], int(match.group(1))
@@ -0,0 +1,136 @@
+import errno
+import hashlib
+import json
+import os
+import shutil
+import stat
+import time
+
+from .state import file_lock, write_atomically
+
+
+def file_checksum(filename, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class StagingCache:
+    # Content-addressed copies of the input files of the jobs, shared by the
+    # runs of the pipelines: every content is copied once, to
+    # 'objects/<sha256>', and linked (hard links, or symbolic links across
+    # filesystems) where the jobs expect it. The checksums of the source
+    # files are kept on 'index.json' with their size and modification time,
+    # so an unchanged file is not read again on the next run. The objects
+    # are read-only: a job that modifies a staged file in place would change
+    # it for every run that links it.
+    def __init__(self, directory, link="hard"):
+        self.directory = directory
+        self.link_mode = link
+        self.index_filename = os.path.join(directory, "index.json")
+        self.index = None
+
+    def __load_index(self):
+        try:
+            with open(self.index_filename, "rt") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    def object_filename(self, checksum):
+        return os.path.join(self.directory, "objects", checksum[:2], checksum)
+
+    def checksum(self, filename):
+        filename = os.path.realpath(filename)
+        st = os.stat(filename)
+        if self.index is None:
+            self.index = self.__load_index()
+        entry = self.index.get(filename)
+        if entry is not None and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+            return entry["checksum"]
+        checksum = file_checksum(filename)
+        entry = {"size": st.st_size, "mtime": st.st_mtime_ns, "checksum": checksum}
+        with file_lock(self.index_filename):
+            # other pipelines can add files at the same time
+            self.index = self.__load_index()
+            self.index[filename] = entry
+            write_atomically(self.index_filename, json.dumps(self.index))
+        return checksum
+
+    def store(self, filename):
+        # returns (object filename, checksum); the file is copied only when
+        # the cache does not have its contents yet
+        checksum = self.checksum(filename)
+        object_filename = self.object_filename(checksum)
+        if not os.path.exists(object_filename):
+            os.makedirs(os.path.dirname(object_filename), exist_ok=True)
+            tmp_filename = "{}.{}.tmp".format(object_filename, os.getpid())
+            shutil.copyfile(filename, tmp_filename)
+            if file_checksum(tmp_filename) != checksum:
+                os.remove(tmp_filename)
+                raise Exception("{} changed while it was staged".format(filename))
+            os.chmod(tmp_filename, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp_filename, object_filename)
+        return object_filename, checksum
+
+    def link(self, object_filename, destination):
+        # 'destination' is replaced unless it already is the object
+        folder = os.path.dirname(destination)
+        if len(folder) > 0:
+            os.makedirs(folder, exist_ok=True)
+        if os.path.lexists(destination):
+            if os.path.exists(destination) and os.path.samefile(object_filename, destination):
+                return destination
+        tmp_destination = "{}.{}.tmp".format(destination, os.getpid())
+        if self.link_mode == "hard":
+            try:
+                os.link(object_filename, tmp_destination)
+            except OSError as e:
+                if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                    raise
+                os.symlink(os.path.abspath(object_filename), tmp_destination)
+        else:
+            os.symlink(os.path.abspath(object_filename), tmp_destination)
+        os.replace(tmp_destination, destination)
+        return destination
+
+    def clean(self, max_age=30 * 86400):
+        # Removes the objects not linked anywhere (hard links) that have not
+        # been staged for 'max_age' seconds. The objects linked with symbolic
+        # links cannot be told apart: use a 'max_age' longer than the runs
+        # that use them
+        removed = 0
+        now = time.time()
+        objects = os.path.join(self.directory, "objects")
+        for folder, _, filenames in os.walk(objects):
+            for filename in filenames:
+                path = os.path.join(folder, filename)
+                st = os.stat(path)
+                if st.st_nlink == 1 and now - max(st.st_atime, st.st_mtime, st.st_ctime) > max_age:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+    @staticmethod
+    def scratch_script(variable, files):
+        # Lines of a job script that copy 'files' ((object filename, name,
+        # checksum or None)) to a node-local folder in '$variable', check the
+        # checksums and remove the folder when the script (or subshell) ends.
+        # The trap replaces the previous one: the lines of a task run on a
+        # subshell, so the folder of the job is not removed before the job ends
+        lines = [
+            '{}=$(mktemp -d "${{TMPDIR:-/tmp}}/questpipe.XXXXXX") || exit 1'.format(variable),
+            "trap 'rm -rf \"${}\"' EXIT".format(variable)]
+        folders = sorted(set(os.path.dirname(name) for _, name, _ in files if len(os.path.dirname(name)) > 0))
+        if len(folders) > 0:
+            lines.append('( cd "${}" && mkdir -p {} ) || exit 1'.format(variable, " ".join('"{}"'.format(folder) for folder in folders)))
+        for object_filename, name, _ in files:
+            lines.append('cp "{}" "${}/{}" || exit 1'.format(object_filename, variable, name))
+        checksums = ["{}  {}".format(checksum, name) for _, name, checksum in files if checksum is not None]
+        if len(checksums) > 0:
+            lines.append('( cd "${}" && sha256sum -c --quiet ) <<__QP_CHECKSUMS || {{ echo "questpipe: staged files are corrupted" >&2; exit 1; }}'.format(variable))
+            lines += checksums
+            lines.append("__QP_CHECKSUMS")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,95 @@
+import contextlib
+import fcntl
+import json
+import os
+import threading
+
+
+def write_atomically(filename, content):
+    # the file is either the old one or the new one, even if the process dies
+    tmp_filename = "{}.tmp".format(filename)
+    with open(tmp_filename, "wt") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+@contextlib.contextmanager
+def file_lock(filename):
+    # exclusive lock of a file shared by the questpipe processes of the user
+    folder = os.path.dirname(filename)
+    if len(folder) > 0:
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+    with open("{}.lock".format(filename), "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class StateJournal:
+    # Append-only log of the job transitions of a pipeline, stored next to the
+    # snapshot ('pipeline.json' -> 'pipeline.json.journal'). Every record is a
+    # JSON line; the records after the last snapshot are replayed on load.
+    def __init__(self, filename, compact_every=1000, sync=False):
+        self.filename = filename
+        self.compact_every = compact_every
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.records = 0
+        self.file = None
+
+    @staticmethod
+    def journal_filename(filename):
+        return "{}.journal".format(filename)
+
+    def write_snapshot(self, to_json):
+        # 'to_json' is called holding the lock, so no transition is recorded
+        # between the snapshot and the truncation of the journal
+        with self.lock:
+            write_atomically(self.filename, json.dumps(
+                to_json(),
+                sort_keys=True,
+                indent=4,
+                separators=(',', ': ')))
+            # replaying a record already on the snapshot is harmless, so the
+            # journal is truncated after replacing the snapshot
+            if self.file is not None:
+                self.file.close()
+            self.file = open(StateJournal.journal_filename(self.filename), "wt")
+            self.records = 0
+
+    def append(self, record):
+        # returns True when the journal should be compacted
+        with self.lock:
+            if self.file is None:
+                return False
+            self.file.write("{}\n".format(json.dumps(record, sort_keys=True)))
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+            self.records += 1
+            return self.records >= self.compact_every
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    @staticmethod
+    def read(filename):
+        records = []
+        journal_filename = StateJournal.journal_filename(filename)
+        if not os.path.exists(journal_filename):
+            return records
+        with open(journal_filename, "rt") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # the last record can be incomplete if the process died writing it
+                    break
+        return records
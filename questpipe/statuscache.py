@@ -0,0 +1,76 @@
+import json
+import os
+import time
+
+from .monitor import PipelineMonitor
+from .state import file_lock, write_atomically
+
+
+class StatusCache:
+    # States of the scheduler jobs shared by all the questpipe processes of
+    # the user (qp_checkjobs, wait_for_pipeline...) through a file. A process
+    # only asks the scheduler for the jobs whose cached state is older than
+    # 'ttl' seconds and, with the same query, refreshes the jobs that other
+    # processes asked for during the last 'watch_time' seconds. Finished jobs
+    # do not change, so they are not asked again (unless 'force').
+    def __init__(self, filename=None, ttl=30, watch_time=600, keep_time=86400):
+        self.filename = filename if filename is not None else StatusCache.default_filename()
+        self.ttl = ttl
+        self.watch_time = watch_time
+        self.keep_time = keep_time
+        # seconds since the oldest state returned by the last query
+        self.age = None
+
+    @staticmethod
+    def default_filename():
+        return os.path.join(os.path.expanduser("~"), ".questpipe", "status_cache.json")
+
+    def __read(self):
+        try:
+            with open(self.filename, "rt") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            # a missing or broken cache is rebuilt
+            return {}
+
+    def __is_stale(self, entry, now):
+        if entry.get("time") is None:
+            return True
+        # a job not listed by the scheduler (None) is asked again after 'ttl':
+        # it may have been missing from a partial answer
+        if entry["state"] in PipelineMonitor.FINISHED_STATES:
+            return False
+        return now - entry["time"] > self.ttl
+
+    def query(self, job_ids, fetch, force=False):
+        # 'fetch' asks the scheduler: it returns {job_id: (state, exit code)}
+        # and the jobs that are not returned are done
+        now = time.time()
+        with file_lock(self.filename):
+            jobs = self.__read()
+            requested = set(job_ids)
+            for job_id in job_ids:
+                jobs.setdefault(job_id, {"time": None, "state": None, "exit_code": None})["requested"] = now
+            stale = [job_id for job_id in job_ids if force or self.__is_stale(jobs[job_id], now)]
+            if len(stale) > 0:
+                stale += [
+                    job_id for job_id, entry in jobs.items()
+                    if job_id not in requested and now - entry.get("requested", 0) < self.watch_time and self.__is_stale(entry, now)]
+                # when 'fetch' fails nothing is written
+                states = fetch(stale)
+                for job_id in stale:
+                    state, exit_code = states.get(job_id, (None, None))
+                    jobs[job_id].update(time=now, state=state, exit_code=exit_code)
+            for job_id in [job_id for job_id, entry in jobs.items() if now - entry.get("requested", 0) > self.keep_time]:
+                del jobs[job_id]
+            write_atomically(self.filename, json.dumps(jobs))
+
+        result = {}
+        oldest = now
+        for job_id in job_ids:
+            entry = jobs[job_id]
+            oldest = min(oldest, entry["time"])
+            if entry["state"] is not None:
+                result[job_id] = (entry["state"], entry["exit_code"])
+        self.age = now - oldest
+        return result
@@ -0,0 +1,115 @@
+import functools
+import re
+import string
+
+
+FORMATTER = string.Formatter()
+KEY_RE = re.compile(r"[^.\[]*")
+
+
+@functools.lru_cache(maxsize=4096)
+def template_keys(template):
+    # root keys of the placeholders of 'template', including the nested ones
+    # on format specs ("{value:{width}}")
+    keys = []
+    for _, field_name, format_spec, _ in FORMATTER.parse(template):
+        if field_name is None:
+            continue
+        key = KEY_RE.match(field_name).group(0)
+        if key == "" or key.isdigit():
+            raise Exception("positional placeholder '{{{}}}' in template {!r}".format(field_name, template))
+        if key not in keys:
+            keys.append(key)
+        if format_spec:
+            for nested_key in template_keys(format_spec):
+                if nested_key not in keys:
+                    keys.append(nested_key)
+    return tuple(keys)
+
+
+class TemplateResolver:
+    # Renders templates over a set of values, where the values can be
+    # templates too. The placeholders of every value are parsed once, the
+    # resolved values are memoized, and every template is rendered with a
+    # single 'format' call.
+    #
+    # A resolver can have a parent: values not defined here are taken from
+    # the parent, and resolved on the parent (sharing its memo) unless they
+    # reference, directly or not, a value overridden here.
+    def __init__(self, values, parent=None):
+        self.values = values
+        self.parent = parent
+        self.keys = {}
+        self.closures = {}
+        self.resolved = {}
+
+    def has(self, key):
+        resolver = self
+        while resolver is not None:
+            if key in resolver.values:
+                return True
+            resolver = resolver.parent
+        return False
+
+    def raw(self, key):
+        resolver = self
+        while resolver is not None:
+            if key in resolver.values:
+                return resolver.values[key]
+            resolver = resolver.parent
+        raise KeyError(key)
+
+    def references(self, key):
+        if key not in self.keys:
+            value = self.raw(key)
+            self.keys[key] = template_keys(value) if isinstance(value, str) else []
+        return self.keys[key]
+
+    def closure(self, key):
+        # every key needed to resolve 'key', including the ones undefined here;
+        # cycles are reported by 'resolve'
+        if key not in self.closures:
+            result = set()
+            pending = [key]
+            while len(pending) > 0:
+                current = pending.pop()
+                if current in result:
+                    continue
+                result.add(current)
+                if self.has(current):
+                    pending.extend(self.references(current))
+            self.closures[key] = result
+        return self.closures[key]
+
+    def resolve(self, key, template=None, path=()):
+        if key in self.resolved:
+            return self.resolved[key]
+        if key in path:
+            cycle = list(path[path.index(key):]) + [key]
+            raise Exception("recursive parsing: {}".format(" -> ".join(cycle)))
+        if key not in self.values:
+            if self.parent is None or not self.parent.has(key):
+                if template is None:
+                    raise Exception("undefined key '{}'".format(key))
+                if len(path) > 0:
+                    raise Exception("undefined key '{}' in template {!r} of key '{}'".format(key, template, path[-1]))
+                raise Exception("undefined key '{}' in template {!r}".format(key, template))
+            if self.parent.closure(key).isdisjoint(self.values):
+                return self.parent.resolve(key, template, path)
+
+        value = self.raw(key)
+        if isinstance(value, str):
+            value = self.__render(value, path + (key,))
+        self.resolved[key] = value
+        return value
+
+    def render(self, template):
+        return self.__render(template, ())
+
+    def __render(self, template, path):
+        keys = template_keys(template)
+        if len(keys) == 0:
+            # unescape '{{' and '}}'
+            return template.format()
+        values = {key: self.resolve(key, template, path) for key in keys}
+        return template.format(**values)
@@ -0,0 +1,121 @@
+import asyncio
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    # At most 'rate' operations per second, with bursts of 'burst'. 'reserve'
+    # takes a token and returns the seconds to wait before using it, so the
+    # same bucket works with threads (time.sleep) and asyncio (asyncio.sleep)
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class CircuitBreaker:
+    # Opens after 'failure_threshold' consecutive failures: nothing is sent
+    # to the scheduler for 'reset_timeout' seconds. Then one operation is
+    # allowed; if it fails, the circuit opens again. If it ends without an
+    # answer of the scheduler ('released'), the next operation is the probe
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def delay(self):
+        # seconds to wait before the next operation
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return 0
+            remaining = self.opened + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                return remaining
+            if self.state == CircuitBreaker.OPEN:
+                # this operation is the probe, the rest wait for it
+                self.state = CircuitBreaker.HALF_OPEN
+                return 0
+            return min(self.reset_timeout, 1)
+
+    def succeeded(self):
+        with self.lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def released(self):
+        with self.lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self.state = CircuitBreaker.OPEN
+
+    def failed(self):
+        # returns True when the circuit opens
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                opening = self.state != CircuitBreaker.OPEN
+                self.state = CircuitBreaker.OPEN
+                self.opened = time.monotonic()
+                return opening
+            return False
+
+
+class SubmissionThrottle:
+    # Pace of the submissions of a pipeline: at most 'rate' jobs per second
+    # (None: no limit), exponential backoff with full jitter between the
+    # attempts of a job ('backoff' seconds doubled on every attempt, up to
+    # 'max_backoff'), and a circuit breaker shared by all the submissions
+    def __init__(self, rate=None, burst=1, backoff=1.0, max_backoff=60, failure_threshold=5, reset_timeout=60):
+        self.bucket = TokenBucket(rate, burst) if rate is not None else None
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    def wait(self):
+        # blocks until the next submission can be sent
+        delay = self.breaker.delay()
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.breaker.delay()
+        if self.bucket is not None:
+            time.sleep(self.bucket.reserve())
+
+    async def wait_async(self):
+        delay = self.breaker.delay()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.breaker.delay()
+        if self.bucket is not None:
+            await asyncio.sleep(self.bucket.reserve())
+
+    def retry_delay(self, attempt):
+        # 'attempt' is the number of failed attempts of the job (0 based)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def succeeded(self):
+        self.breaker.succeeded()
+
+    def failed(self):
+        return self.breaker.failed()
+
+    def released(self):
+        self.breaker.released()
@@ -44,6 +44,7 @@ def main(project_id):
 
     with qp.Pipeline(name=name, join_command_arguments=True, arguments=arguments) as pipeline:
         pipeline.debug_to_filename("{rundir}/pipeline.log", create_parent_folders=True)
+        pipeline.save_state("{rundir}/pipeline.json")
 
         # STEP 1: Create the folders to store the data
         _, stdout, stderr = pipeline.run("""
@@ -58,9 +59,12 @@ def main(project_id):
             mkdir -p "{rundir}/06_eda"
         """)
 
+        # The jobs are declared with their command and submitted together at
+        # the end (submit_all), so the report does not wait for every tophat
+        # job on a single 'depend' list
+
         # STEP 2: Create fastq files
-        t1 = pipeline.create_job(name="00_bcl2fastq")
-        t1.prepare_async_run("""
+        t1 = pipeline.create_job(name="00_bcl2fastq", command="""
             module load bcl2fastq/2.17.1.14
             bcl2fastq -R {project_dir} -r {num_processors} -d {num_processors} -p {num_processors} -w {num_processors}
             """)
@@ -73,45 +77,45 @@ def main(project_id):
             if data["Sample_Project"] != arguments.values["project_id"]:
                 continue
 
-            tasks = []
+            lanes_arguments = []
             fastq_filenames = []
             for line in [1, 2, 3, 4]:
                 sample_filename = "{}_S{}_L{:03}_R1_001".format(data["Sample_Name"], index+1, line)
-                fastq_filenames.append("{rundir}/02_trimmed/{sample_filename}.trimmed.fastq.gz")
-                current_t = pipeline.create_job(
-                    name="01_fastqc_{sample_filename}", 
-                    dependences=[t1],
-                    local_arguments=qp.Arguments(
-                        sample_id=data["Sample_ID"],
-                        sample_name=data["Sample_Name"],
-                        sample_filename=sample_filename))
-
-                current_t.async_run("""
-                    module load fastqc/0.11.5
-                    module load java
-                    
-                    cp {project_dir}/Data/Intensities/BaseCalls/{project_id}/{sample_id}/{sample_filename}.fastq.gz \
-                        {rundir}/00_fastq
-                    fastqc -o {rundir}/01_fastqc {rundir}/00_fastq/{sample_filename}.fastq.gz
-                    java -jar /projects/b1038/tools/Trimmomatic-0.36/trimmomatic-0.36.jar SE \
-                        -threads {num_processors} \
-                        -phred33 {rundir}/00_fastq/{sample_filename}.fastq.gz \
-                        {rundir}/02_trimmed/{sample_filename}.trimmed.fastq \
-                        TRAILING:30 MINLEN:20 
-                    gzip {rundir}/02_trimmed/{sample_filename}.trimmed.fastq
-                    fastqc -o {rundir}/03_fastqc {rundir}/02_trimmed/{sample_filename}.trimmed.fastq.gz
-                    """)
-                tasks.append(current_t)
-            
+                fastq_filenames.append("{{rundir}}/02_trimmed/{}.trimmed.fastq.gz".format(sample_filename))
+                lanes_arguments.append(qp.Arguments(
+                    sample_id=data["Sample_ID"],
+                    sample_name=data["Sample_Name"],
+                    sample_filename=sample_filename))
+
+            # one job array with an element for each lane
+            fastqc_t = pipeline.create_job_array(
+                name="01_fastqc_{}".format(data["Sample_Name"]),
+                elements_arguments=lanes_arguments,
+                dependences=[t1],
+                command="""
+                module load fastqc/0.11.5
+                module load java
+                
+                cp {project_dir}/Data/Intensities/BaseCalls/{project_id}/{sample_id}/{sample_filename}.fastq.gz \
+                    {rundir}/00_fastq
+                fastqc -o {rundir}/01_fastqc {rundir}/00_fastq/{sample_filename}.fastq.gz
+                java -jar /projects/b1038/tools/Trimmomatic-0.36/trimmomatic-0.36.jar SE \
+                    -threads {num_processors} \
+                    -phred33 {rundir}/00_fastq/{sample_filename}.fastq.gz \
+                    {rundir}/02_trimmed/{sample_filename}.trimmed.fastq \
+                    TRAILING:30 MINLEN:20 
+                gzip {rundir}/02_trimmed/{sample_filename}.trimmed.fastq
+                fastqc -o {rundir}/03_fastqc {rundir}/02_trimmed/{sample_filename}.trimmed.fastq.gz
+                """)
+
             # Run tophat
             tophat_t = pipeline.create_job(
                 name="02_tophat_{sample_name}",
-                dependences=tasks,
+                dependences=[fastqc_t],
                 local_arguments=qp.Arguments(
                     sample_name=data["Sample_Name"],
-                    fastq_filenames=",".join(fastq_filenames)))
-
-            tophat_t.async_run("""
+                    fastq_filenames=",".join(fastq_filenames)),
+                command="""
                 module load tophat/2.1.0
                 module load samtools
                 module load bowtie2/2.2.6
@@ -140,8 +144,8 @@ def main(project_id):
 
         t4 = pipeline.create_job(
             name="03_alignment_report",
-            dependences=step3_tasks)
-        t4.async_run("""
+            dependences=step3_tasks,
+            command="""
             module load R/3.3.1
 
             Rscript /projects/p20742/tools/createTophatReport.R --topHatDir={rundir}/04_alignment/ --nClus={num_processors}
@@ -149,8 +153,8 @@ def main(project_id):
 
         t5 = pipeline.create_job(
             name="04_quantification",
-            dependences=[t4])
-        t5.async_run("""
+            dependences=[t4],
+            command="""
             perl /projects/p20742/tools/makeHTseqCountsTable.pl {rundir}/04_alignment \
                 {quantification_transcriptome_index} \
                 {rundir}/05_quantification
@@ -158,7 +162,7 @@ def main(project_id):
             ln -s {rundir} {project_dir}/latest
             """)
 
-        t1.unhold()
+        pipeline.submit_all()
 
         state_filename = pipeline.save_state("{rundir}/pipeline.json")
         print("Stored at {}".format(state_filename))